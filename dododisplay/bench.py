@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# End to end benchmark of the planning run (update_events.main), offline.
+#
+#   bench.py [--users N] [--events M] [--cassette FILE]
+#            [--latency maps=0.1,owm=0.05,calendar=0.08] [--db 15]
+#       plans M synthetic events for N synthetic users and reports the wall
+#       time, the API calls per service and p50/p95 of every stage. Calendar
+#       answers are synthetic; Maps and OpenWeatherMap are replayed from the
+#       cassette if given, otherwise synthetic too. --trace FILE also writes
+#       the spans (see tracing.py).
+#   bench.py --record FILE [user]
+#       runs the planning of a real user against the real APIs and records
+#       the Maps and OpenWeatherMap responses in the cassette FILE (the
+#       calendars and the OAuth tokens are never recorded)
+#
+# The redis db given with --db (on the usual socket) is flushed and used for
+# the synthetic sessions and caches: keep it for the benchmark only.
+import argparse
+import budget
+import calendar_batch
+import cassette
+import contextlib
+import directions
+import io
+import redis
+import session
+import simplejson as json
+import time
+import tracing
+import travel_times
+import update_events
+import weather
+from collections import defaultdict
+from datetime import datetime, timezone
+from urllib.parse import parse_qs, urlsplit
+
+# Spans (see tracing.py) reported as stages
+STAGES = ["main", "session load", "event fetch", "planning", "plan event",
+          "departure search", "directions", "maps api", "weather",
+          "description", "event update"]
+VEHICLES = [("car", "bus"), ("bus", "car"), ("train", "car"),
+            ("bicycle", "bus"), ("male", "train")]
+DURATIONS = {"driving": 1500, "transit": 2400, "walking": 4800,
+             "bicycling": 1800}
+JSON = {"Content-Type": "application/json"}
+
+
+def _query(request):
+    return {k: v[0] for k, v in parse_qs(urlsplit(request.url).query).items()}
+
+
+def _iso(t):
+    return datetime.fromtimestamp(t, timezone.utc).isoformat()
+
+
+# M events, one every 5 hours from the next hour on
+def synthetic_events(m):
+    start = int(time.time()) // 3600 * 3600 + 3600
+    return [{
+        "id": "bench{}".format(j),
+        "status": "confirmed",
+        "summary": "Bench event {}".format(j),
+        "start": {"dateTime": _iso(start + j * 5 * 3600)},
+        "end": {"dateTime": _iso(start + j * 5 * 3600 + 3600)},
+        "reminders": {"useDefault": True}
+    } for j in range(m)]
+
+
+def events_responder(m):
+    def respond(request):
+        # Incremental syncs: nothing changed
+        items = [] if "syncToken" in _query(request) else synthetic_events(m)
+        return 200, JSON, json.dumps({"items": items, "nextSyncToken": "b"})
+    return respond
+
+
+def batch_responder(request):
+    body = request.body
+    if isinstance(body, bytes):
+        body = body.decode("utf-8")
+    content_type, payload = calendar_batch.stub_responses(
+        request.headers["Content-Type"], body)
+    return 200, {"Content-Type": content_type}, payload.decode("utf-8")
+
+
+def directions_responder(request):
+    q = _query(request)
+    mode = q.get("mode", "driving")
+    duration = DURATIONS[mode]
+    if "arrival_time" in q:
+        arrival = int(q["arrival_time"])
+        departure = arrival - duration
+    else:
+        departure = int(q.get("departure_time", time.time()))
+        arrival = departure + duration
+    leg = {
+        "duration": {"value": duration},
+        "distance": {"value": 12000},
+        "departure_time": {"value": departure},
+        "arrival_time": {
+            "value": arrival,
+            "text": time.strftime("%H:%M", time.localtime(arrival))
+        },
+        "steps": [{
+            "travel_mode": "TRANSIT",
+            "transit_details": {
+                "line": {
+                    "short_name": "42",
+                    "vehicle": {"type": "BUS", "name": "Bus"}
+                },
+                "departure_stop": {"name": "Bench stop"}
+            }
+        }, {
+            "travel_mode": "TRANSIT",
+            "transit_details": {
+                "line": {"vehicle": {"type": "HEAVY_RAIL", "name": "Train"}},
+                "headsign": "Bench",
+                "departure_stop": {"name": "Bench station"}
+            }
+        }] if mode == "transit" else []
+    }
+    if mode == "driving":
+        # Traffic changes with the departure time
+        leg["duration_in_traffic"] = {"value": duration + departure % 900}
+    return 200, JSON, json.dumps({
+        "status": "OK",
+        "routes": [{"summary": "Bench", "legs": [leg]}]
+    })
+
+
+def _owm_weather(t):
+    return {
+        "dt": t,
+        "main": {"temp": 288.15, "temp_min": 287, "temp_max": 289,
+                 "humidity": 60, "pressure": 1013},
+        "weather": [{"id": 500, "main": "Rain",
+                     "description": "light rain", "icon": "10d"}],
+        "clouds": {"all": 40},
+        "wind": {"speed": 3.0, "deg": 200},
+        "rain": {"3h": 0.5}
+    }
+
+
+def forecast_responder(request):
+    q = _query(request)
+    start = int(time.time()) // 10800 * 10800
+    return 200, JSON, json.dumps({
+        "cod": "200",
+        "cnt": 40,
+        "city": {
+            "id": 1,
+            "name": "Bench",
+            "country": "IT",
+            "coord": {"lat": float(q["lat"]), "lon": float(q["lon"])}
+        },
+        "list": [_owm_weather(start + i * 10800) for i in range(40)]
+    })
+
+
+def weather_responder(request):
+    q = _query(request)
+    return 200, JSON, json.dumps(dict(
+        _owm_weather(int(time.time())),
+        id=1,
+        name="Bench",
+        cod=200,
+        coord={"lat": float(q["lat"]), "lon": float(q["lon"])},
+        sys={"country": "IT"}))
+
+
+def _location(name, lat, lng):
+    return {
+        "address_components": [{"long_name": name}],
+        "geometry": {"location": {"lat": lat, "lng": lng}}
+    }
+
+
+# Sessions laid out as dodohome stores them (hash fields), each user with
+# its own locations so caches start cold
+def create_users(conn, n):
+    users = []
+    for i in range(n):
+        user = "bench{}@example.com".format(i)
+        key = "session:bench{}".format(i)
+        primary, secondary = VEHICLES[i % len(VEHICLES)]
+        data = {
+            "oauth_token": {
+                "access_token": "bench",
+                "refresh_token": "bench",
+                "token_type": "Bearer",
+                "expires_at": time.time() + 365 * 24 * 3600
+            },
+            "username": {"email": user},
+            "default_calendar": user,
+            "primary_vehicle": primary,
+            "secondary_vehicle": secondary,
+            "location_work": _location("Work", 45.46 + i * 0.01, 9.19),
+            "location_work_full": "Work {}".format(i),
+            "location_home": _location("Home", 45.50 + i * 0.01, 9.23),
+            "location_home_full": "Home {}".format(i),
+        }
+        conn.hmset(key, {k: json.dumps(v) for k, v in data.items()})
+        conn.hset(session.Session._USERS_INDEX, user, key)
+        conn.sadd(session.Session._TOKENS_INDEX, key)
+        users.append(user)
+    return users
+
+
+# The classes keep their connections as class attributes: point them to the
+# benchmark db, with budgets that never throttle
+def use_redis(conn):
+    unlimited = budget.Budget(conn, {api: (10000, None)
+                                     for api in budget.LIMITS})
+    session.Session._redis_conn = conn
+    session.Session._budget = unlimited
+    directions.Directions._redis_conn = conn
+    directions.Directions._budget = unlimited
+    directions.Directions._history = travel_times.TravelTimes(":memory:")
+    weather.Weather._budget = unlimited
+    # googlemaps refuses empty keys
+    directions.Directions._Directions__GOOGLEMAPS_KEY = "AIzaBench"
+
+
+def report(wall, users, events, calls, timings):
+    print("Users: {}, events per user: {}".format(users, events))
+    print("Wall time: {:.3f} s".format(wall))
+    print("API calls:", ", ".join(
+        "{} {}".format(s, c) for s, c in sorted(calls.items())))
+    print("{:<18}{:>8}{:>12}{:>12}".format("stage", "calls", "p50 (ms)",
+                                           "p95 (ms)"))
+    for name in STAGES:
+        values = sorted(timings.get(name, ()))
+        if not values:
+            continue
+        print("{:<18}{:>8}{:>12.1f}{:>12.1f}".format(
+            name, len(values),
+            travel_times.quantile(values, 0.5) * 1000,
+            travel_times.quantile(values, 0.95) * 1000))
+
+
+def bench(args):
+    conn = redis.Redis(unix_socket_path=args.socket, db=args.db)
+    conn.flushdb()
+    use_redis(conn)
+    users = create_users(conn, args.users)
+    latency = {}
+    for item in filter(None, args.latency.split(",")):
+        name, seconds = item.split("=")
+        latency[name] = float(seconds)
+    responders = {
+        "GET www.googleapis.com/calendar/v3/calendars/*/events":
+        events_responder(args.events),
+        "POST www.googleapis.com/batch/calendar/v3": batch_responder,
+    }
+    if not args.cassette:
+        responders.update({
+            "GET maps.googleapis.com/maps/api/directions":
+            directions_responder,
+            "GET api.openweathermap.org/data/2.5/forecast":
+            forecast_responder,
+            "GET api.openweathermap.org/data/2.5/weather": weather_responder,
+        })
+    timings = defaultdict(list)
+    tracing.collect()
+    tape = cassette.Cassette(args.cassette, "replay", latency, responders)
+    with tape:
+        start = time.perf_counter()
+        for user in users:
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                update_events.main(user, args.events)
+            if args.verbose:
+                print(out.getvalue())
+        wall = time.perf_counter() - start
+    spans = tracing.collect()
+    for s in spans:
+        timings[s.name].append(s.duration)
+    if args.trace:
+        tracing.export(args.trace, spans)
+    report(wall, args.users, args.events, tape.calls, timings)
+
+
+def record(args):
+    with cassette.Cassette(args.record, "record") as tape:
+        update_events.main(args.user)
+    print("Recorded calls:", dict(tape.calls))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--events", type=int, default=3)
+    parser.add_argument("--cassette")
+    parser.add_argument("--latency", default="")
+    parser.add_argument("--socket", default="/run/redis/redis.sock")
+    parser.add_argument("--db", type=int, default=15)
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--trace")
+    parser.add_argument("--record")
+    parser.add_argument("user", nargs="?")
+    args = parser.parse_args()
+    if args.record:
+        record(args)
+    else:
+        bench(args)
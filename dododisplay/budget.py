@@ -0,0 +1,136 @@
+import time
+
+# Shared between dodohome and dododisplay: keep both copies in sync
+BUDGET_PREFIX = "budget:"
+# Priority classes: interactive requests (the web app) beat background
+# planning, which can not use the last BACKGROUND_RESERVE share of the
+# daily quota nor of the burst capacity
+INTERACTIVE = 0
+BACKGROUND = 1
+BACKGROUND_RESERVE = 0.2
+# API -> (requests per second, daily quota or None), defaults for the limits
+# published in redis (dodohome publishes the ones of its settings)
+LIMITS = {
+    "maps": (10, 2500),
+    "owm": (1, 1000),
+    "calendar": (10, 1000000),
+}
+
+# Token bucket and daily counter of an API, updated atomically in redis so
+# every process draws from the same budget. Returns 0 when a request can be
+# made, the milliseconds to wait for a token, or -1 when the quota is over.
+# The redis clock is used, the processes can run on different machines
+# (scripts calling TIME need redis >= 5).
+# The bucket holds the burst (one second of requests, at least one) plus the
+# tokens held back for the interactive callers: a background caller always
+# gets its token once the bucket is full.
+TAKE = """
+local limits = redis.call("HMGET", KEYS[3], "rate", "quota")
+local rate = tonumber(limits[1]) or tonumber(ARGV[1])
+local quota = tonumber(limits[2]) or tonumber(ARGV[2])
+local background, reserve = tonumber(ARGV[3]) == 1, tonumber(ARGV[4])
+local held = math.max(1, rate) * reserve
+local capacity = math.max(1, rate) + held
+local clock = redis.call("TIME")
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local used = tonumber(redis.call("GET", KEYS[2]) or "0")
+if quota > 0 and used >= quota * (1 - (background and reserve or 0)) then
+    return -1
+end
+local needed = 1 + (background and held or 0)
+local wait = 0
+if tokens >= needed then
+    tokens = tokens - 1
+    redis.call("INCR", KEYS[2])
+    redis.call("EXPIRE", KEYS[2], 2 * 24 * 3600)
+else
+    wait = math.ceil((needed - tokens) / rate * 1000)
+end
+redis.call("HMSET", KEYS[1], "tokens", tostring(tokens), "ts", tostring(now))
+redis.call("EXPIRE", KEYS[1], 3600)
+return wait
+"""
+
+
+class OverBudget(Exception):
+    pass
+
+
+# Request budget of the external APIs, shared through redis. limits (API ->
+# (rate, quota)) are published for every process; without them the ones
+# already published, or the defaults, are used.
+class Budget:
+    def __init__(self, redis, limits=None):
+        self._redis = redis
+        self._limits = dict(LIMITS, **(limits or {}))
+        self._take = redis.register_script(TAKE)
+        for api, (rate, quota) in (limits or {}).items():
+            redis.hmset(self._limits_key(api), {
+                "rate": rate,
+                "quota": quota or 0
+            })
+
+    def _keys(self, api):
+        return [
+            BUDGET_PREFIX + api + ":bucket",
+            BUDGET_PREFIX + api + ":day:" + time.strftime("%Y-%m-%d"),
+            self._limits_key(api)
+        ]
+
+    def _limits_key(self, api):
+        return BUDGET_PREFIX + api + ":limits"
+
+    # Wait for a request slot of the API, up to max_wait seconds. Raises
+    # OverBudget when the daily quota is over or the wait would be longer:
+    # callers should fall back to cached (even stale) data.
+    def acquire(self, api, priority=INTERACTIVE, max_wait=10):
+        rate, quota = self._limits[api]
+        deadline = time.monotonic() + max_wait
+        while True:
+            wait = int(
+                self._take(
+                    keys=self._keys(api),
+                    args=[
+                        rate, quota or 0,
+                        int(priority == BACKGROUND), BACKGROUND_RESERVE
+                    ]))
+            if wait == 0:
+                return
+            if wait < 0:
+                raise OverBudget("{} daily quota exhausted".format(api))
+            if time.monotonic() + wait / 1000 > deadline:
+                raise OverBudget("{} rate limit".format(api))
+            time.sleep(wait / 1000)
+
+    # Requests left today (None without a quota) of every API
+    def remaining(self):
+        report = {}
+        for api in self._limits:
+            published = self._redis.hget(self._limits_key(api), "quota")
+            quota = (int(float(published)) if published is not None else
+                     self._limits[api][1])
+            used = int(self._redis.get(self._keys(api)[1]) or 0)
+            report[api] = max(0, quota - used) if quota else None
+        return report
+
+
+# Check of the limits on a scratch redis db (flushed): on a fresh bucket
+# every API must grant a token to both priorities without waiting
+#   budget.py [--db 15]
+if __name__ == "__main__":
+    import argparse
+    from redis import Redis
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", default="/run/redis/redis.sock")
+    parser.add_argument("--db", type=int, default=15)
+    args = parser.parse_args()
+    conn = Redis(unix_socket_path=args.socket, db=args.db)
+    for api in LIMITS:
+        for priority in (BACKGROUND, INTERACTIVE):
+            conn.flushdb()
+            Budget(conn).acquire(api, priority, max_wait=0)
+    print("Every API grants a token on a fresh bucket")
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+import re
+import simplejson as json
+import sys
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+BATCH_URL = "https://www.googleapis.com/batch/calendar/v3"
+# Google accepts up to 50 calls in a single batch request
+BATCH_SIZE = 50
+
+
+# parts: list of (content id, start line, JSON body) -> (content type, payload)
+def _encode(parts):
+    boundary = "batch_" + uuid.uuid4().hex
+    payload = ""
+    for content_id, start_line, body in parts:
+        payload += "--{}\r\n".format(boundary)
+        payload += "Content-Type: application/http\r\n"
+        payload += "Content-ID: <{}>\r\n\r\n".format(content_id)
+        payload += "{}\r\nContent-Type: application/json\r\n\r\n".format(
+            start_line)
+        payload += "{}\r\n".format(json.dumps(body))
+    payload += "--{}--\r\n".format(boundary)
+    return "multipart/mixed; boundary=" + boundary, payload.encode("utf-8")
+
+
+# requests: list of (method, path, body), path relative to googleapis.com
+def encode_requests(requests):
+    return _encode([("item{}".format(i), "{} {} HTTP/1.1".format(m, p), b)
+                    for i, (m, p, b) in enumerate(requests)])
+
+
+def encode_responses(responses):
+    return _encode([("response-{}".format(c), "HTTP/1.1 {}".format(s), b)
+                    for c, s, b in responses])
+
+
+# Split a multipart/mixed batch into (content id, start line, body) parts
+def decode(content_type, payload):
+    boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1)
+    parts = []
+    for part in payload.replace("\r\n", "\n").split("--" + boundary):
+        part = part.strip()
+        if not part or part == "--":
+            continue
+        mime_headers, _, message = part.partition("\n\n")
+        content_id = re.search(r"Content-ID:\s*<([^>]*)>", mime_headers,
+                               re.IGNORECASE)
+        start_line, _, message = message.partition("\n")
+        _, _, body = message.partition("\n\n")
+        parts.append((content_id.group(1) if content_id else None,
+                      start_line.strip(),
+                      json.loads(body) if body.strip() else None))
+    return parts
+
+
+# Parsed responses of a batch, in the same order of the requests: the
+# (status, body) of each call, None when Google did not answer it (parts
+# without a Content-ID of ours are skipped)
+def decode_responses(content_type, payload, count):
+    responses = [None] * count
+    for content_id, start_line, body in decode(content_type, payload):
+        match = re.search(r"item(\d+)", content_id or "")
+        if match is None or int(match.group(1)) >= count:
+            continue
+        responses[int(match.group(1))] = (int(start_line.split()[1]), body)
+    return responses
+
+
+# Local stand-in for the batch endpoint (for tests): answers every call with
+# the body it received, or 404 for event ids starting with "missing"
+def stub_responses(content_type, payload):
+    responses = []
+    for content_id, start_line, body in decode(content_type, payload):
+        event_id = start_line.split()[1].rstrip("/").split("/")[-1]
+        if event_id.startswith("missing"):
+            responses.append((content_id, "404 Not Found", {
+                "error": {
+                    "code": 404,
+                    "message": "Not Found"
+                }
+            }))
+        else:
+            body = dict(body or {}, id=event_id)
+            responses.append((content_id, "200 OK", body))
+    return encode_responses(responses)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        content_type, payload = stub_responses(
+            self.headers["Content-Type"],
+            self.rfile.read(length).decode("utf-8"))
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+# python3 calendar_batch.py [port], then point Session._url_batch to
+# http://localhost:<port>/batch/calendar/v3
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8088
+    HTTPServer(("localhost", port), StubHandler).serve_forever()
@@ -0,0 +1,169 @@
+import re
+import simplejson as json
+import threading
+import time
+from collections import defaultdict
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from urllib.parse import parse_qsl, urlsplit
+
+# Every external call goes through requests (googlemaps, pyowm and the
+# google-auth sessions): the harness sits in HTTPAdapter.send
+SERVICES = {
+    "maps.googleapis.com": "maps",
+    "api.openweathermap.org": "owm",
+    "www.googleapis.com": "calendar",
+    "oauth2.googleapis.com": "oauth",
+}
+
+
+# Query parameters choosing the answer, part of the request keys
+KEY_PARAMS = {
+    "maps": ("mode", "transit_mode", "transit_routing_preference",
+             "traffic_model", "alternatives"),
+    "owm": ("lat", "lon", "q", "id", "units", "cnt"),
+}
+# Only the public APIs are recorded: the token endpoint and the calendars
+# are answered by responders (see bench.py)
+RECORDED = ("maps", "owm")
+# Fields blanked in the recorded bodies, at any depth
+SECRETS = ("access_token", "refresh_token", "id_token", "client_secret")
+# Response headers never recorded
+PRIVATE_HEADERS = ("content-encoding", "content-length", "transfer-encoding",
+                   "set-cookie", "authorization")
+
+
+def service(url):
+    return SERVICES.get(urlsplit(url).hostname, "other")
+
+
+# Requests are matched by method, host, path and the KEY_PARAMS of their
+# service: the other parameters (times, keys, sync tokens) are ignored and so
+# are calendar and event ids, so a cassette recorded for one user can be
+# replayed for any other
+def request_key(method, url):
+    parts = urlsplit(url)
+    path = re.sub(r"/calendars/[^/]+", "/calendars/*", parts.path)
+    path = re.sub(r"/events/[^/]+$", "/events/*", path)
+    names = KEY_PARAMS.get(service(url), ())
+    params = sorted(
+        (k, v) for k, v in parse_qsl(parts.query) if k in names)
+    query = "?" + "&".join("{}={}".format(k, v)
+                           for k, v in params) if params else ""
+    return "{} {}{}{}".format(method, parts.hostname, path, query)
+
+
+def redact(body):
+    if isinstance(body, dict):
+        return {
+            k: "REDACTED" if k in SECRETS else redact(v)
+            for k, v in body.items()
+        }
+    if isinstance(body, list):
+        return [redact(v) for v in body]
+    return body
+
+
+def _recorded_body(response):
+    try:
+        return json.dumps(redact(response.json()))
+    except ValueError:
+        return response.text
+
+
+def _response(request, status, headers, body):
+    response = Response()
+    response.status_code = status
+    response.headers = CaseInsensitiveDict(headers)
+    response._content = body.encode("utf-8")
+    response.encoding = "utf-8"
+    response.url = request.url
+    response.request = request
+    response.reason = "OK" if status < 400 else "Error"
+    return response
+
+
+# Records the responses of the real APIs (mode "record", only the RECORDED
+# services, with the SECRETS redacted) or plays them back offline (mode
+# "replay"), cycling through the responses recorded for each request key.
+# Responders (key prefix -> function(request) -> (status, headers, body))
+# generate synthetic responses, before the recorded ones.
+# latency: service -> seconds added to every replayed call.
+class Cassette:
+    def __init__(self, path=None, mode="replay", latency=None,
+                 responders=None):
+        self._path = path
+        self._mode = mode
+        self._latency = latency or {}
+        self._responders = responders or {}
+        self._interactions = defaultdict(list)
+        self._played = defaultdict(int)
+        self._lock = threading.Lock()
+        self._send = None
+        # service -> number of calls
+        self.calls = defaultdict(int)
+        if path and mode == "replay":
+            try:
+                with open(path) as f:
+                    self._interactions.update(json.load(f))
+            except FileNotFoundError:
+                print("Cassette not found, only responders:", path)
+
+    def _replay(self, request):
+        key = request_key(request.method, request.url)
+        for prefix, responder in self._responders.items():
+            if key.startswith(prefix):
+                return _response(request, *responder(request))
+        with self._lock:
+            recorded = self._interactions.get(key)
+            if recorded:
+                i = self._played[key]
+                self._played[key] += 1
+                return _response(request, *recorded[i % len(recorded)])
+        raise ConnectionError("No recorded response for " + key)
+
+    def send(self, adapter, request, **kwargs):
+        with self._lock:
+            self.calls[service(request.url)] += 1
+        if self._mode == "record":
+            response = self._send(adapter, request, **kwargs)
+            if not (service(request.url) in RECORDED):
+                return response
+            # The body is kept decoded
+            headers = {
+                k: v
+                for k, v in response.headers.items()
+                if k.lower() not in PRIVATE_HEADERS
+            }
+            with self._lock:
+                self._interactions[request_key(
+                    request.method, request.url)].append(
+                        (response.status_code, headers,
+                         _recorded_body(response)))
+            return response
+        time.sleep(self._latency.get(service(request.url), 0))
+        return self._replay(request)
+
+    def install(self):
+        self._send = HTTPAdapter.send
+        cassette = self
+
+        def send(adapter, request, **kwargs):
+            return cassette.send(adapter, request, **kwargs)
+
+        HTTPAdapter.send = send
+        return self
+
+    def uninstall(self):
+        HTTPAdapter.send = self._send
+        if self._path and self._mode == "record":
+            with open(self._path, "w") as f:
+                json.dump(self._interactions, f)
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, *exc):
+        self.uninstall()
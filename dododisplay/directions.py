@@ -1,8 +1,16 @@
 #!/usr/bin/env python3
+import budget
 import googlemaps
+import hashlib
 import math
+import redis
+import shortlink
 import simplejson as json
-import requests
+import threading
+import time
+import tracing
+import travel_times
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pprint import pprint
 
@@ -15,17 +23,166 @@ TRAVEL_MODES = {
 }
 
 
+# Google transit vehicle types (line.vehicle.type) of each transit mode
+VEHICLE_TYPES = {
+    "bus": ("BUS", "INTERCITY_BUS", "TROLLEYBUS", "SHARE_TAXI"),
+    "train": ("RAIL", "HEAVY_RAIL", "COMMUTER_TRAIN", "HIGH_SPEED_TRAIN",
+              "LONG_DISTANCE_TRAIN"),
+}
+TRANSIT_KINDS = {t: k for k, types in VEHICLE_TYPES.items() for t in types}
+
+
+# What the event description shows of a route
+class RouteSummary:
+    __slots__ = ("mode", "vehicle", "duration", "distance", "via",
+                 "departure_time", "departure_name", "line", "arrival_time")
+    # Fields shown for each kind of route, in order
+    _TRANSIT_FIELDS = ("departure_time", "departure_name", "line",
+                       "arrival_time", "duration", "vehicle")
+    _FIELDS = ("duration", "distance", "vehicle", "via")
+
+    def __init__(self,
+                 mode,
+                 vehicle,
+                 duration,
+                 distance=None,
+                 via=None,
+                 departure_time=None,
+                 departure_name=None,
+                 line=None,
+                 arrival_time=None):
+        self.mode = mode
+        self.vehicle = vehicle
+        # Minutes
+        self.duration = duration
+        # Kilometers
+        self.distance = distance
+        self.via = via
+        self.departure_time = departure_time
+        self.departure_name = departure_name
+        self.line = line
+        self.arrival_time = arrival_time
+
+    def items(self):
+        if self.mode == "transit":
+            return [(f, getattr(self, f)) for f in self._TRANSIT_FIELDS]
+        return [(f, getattr(self, f)) for f in self._FIELDS]
+
+    def as_dict(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return "RouteSummary({})".format(", ".join(
+            "{}={!r}".format(k, v) for k, v in self.items()))
+
+
+# Vehicle names of the non transit modes
+MODE_VEHICLES = {
+    "driving": "car",
+    "walking": "walking",
+    "bicycling": "bicycle"
+}
+
+
+# Seconds of travel of a route, with the traffic when Google knows it
+def route_duration(route):
+    leg = route["legs"][0]
+    return leg.get("duration_in_traffic", leg["duration"])["value"]
+
+
+# Summary of the first leg of a route, walking its steps once. For transit
+# the first step of the wanted kind (bus/train) is shown; a bus route may
+# fall back to the first train
+def parse_route(route, mode, transit_mode=None, fallback=False):
+    leg = route["legs"][0]
+    duration = math.ceil(leg["duration"]["value"] / 60)
+    if mode != "transit":
+        # Walking route used for bicycle: less time
+        if fallback:
+            duration = int(duration / 1.5)
+        return RouteSummary(
+            mode,
+            MODE_VEHICLES[mode],
+            duration,
+            distance=math.ceil(leg["distance"]["value"] / 1000),
+            via=route.get("summary"))
+
+    vehicle = None
+    departure_name = None
+    line = None
+    for step in leg.get("steps", ()):
+        details = step.get("transit_details")
+        if not details:
+            continue
+        line_info = details.get("line", {})
+        vehicle = line_info.get("vehicle", {}).get("name")
+        kind = TRANSIT_KINDS.get(line_info.get("vehicle", {}).get("type"))
+        if kind == transit_mode or (transit_mode == "bus" and kind == "train"):
+            departure_name = details.get("departure_stop", {}).get("name")
+            if kind == "bus":
+                line = line_info.get("short_name")
+            else:
+                line = details.get("headsign")
+            if kind != transit_mode:
+                vehicle += " (BUS not available)"
+            break
+    else:
+        if vehicle:
+            vehicle += " ({} not available)".format(transit_mode.upper())
+    departure_time = leg.get("departure_time")
+    return RouteSummary(
+        mode,
+        vehicle or transit_mode,
+        duration,
+        departure_time=datetime.fromtimestamp(
+            departure_time["value"]).strftime('%d %b - %H:%M')
+        if departure_time else None,
+        departure_name=departure_name,
+        line=line,
+        arrival_time=leg.get("arrival_time", {}).get("text"))
+
+
 class Directions:
     __GOOGLEMAPS_KEY = ""
-    __GOOGLESHORT_KEY = ""
+    # Base url of dodohome, serving the short links
+    __SHORTLINK_BASE = ""
     __PADDING_TIME = 40
     __URL = "https://www.google.it/maps/dir/{}/{}/data={}"
     __PPRINT = False
+    # Concurrent requests to the Directions API
+    _api_slots = threading.BoundedSemaphore(4)
+    # Routes are cached in redis (shared by every run) by query, with the
+    # time rounded down to a bucket: seconds a route is fresh for each mode
+    # (traffic estimates go stale quickly, transit schedules do not)
+    _redis_conn = redis.Redis(unix_socket_path="/run/redis/redis.sock")
+    # Maps requests share the budget with dodohome (see budget.py)
+    _budget = budget.Budget(_redis_conn)
+    _CACHE_PREFIX = "cache:directions:"
+    _CACHE_TTL = {
+        "driving": 600,
+        "transit": 6 * 3600,
+        "walking": 7 * 24 * 3600,
+        "bicycling": 7 * 24 * 3600,
+    }
+    # Transit queries are by arrival and the answer depends on it to the
+    # minute: a connection found for a later deadline could arrive too late
+    _CACHE_BUCKET = {
+        "driving": 300,
+        "transit": 60,
+        "walking": 3600,
+        "bicycling": 3600,
+    }
+    # Background refresh of stale routes
+    _revalidate = ThreadPoolExecutor(max_workers=2)
+    # Routes asked by a latest departure search
+    _MAX_PROBES = 8
+    # Travel times observed, answering instead of the API when confident
+    # (not for transit: the timetable matters, not only the duration)
+    _history = travel_times.TravelTimes()
 
     def __init__(self, work, home):
         self._gmaps = googlemaps.Client(key=self.__GOOGLEMAPS_KEY)
-        self._shorturl = "https://www.googleapis.com/urlshortener/v1/url?key={}".format(
-            self.__GOOGLESHORT_KEY)
+        self._urls = {}
         try:
             self.work_name = work.get("name")
             self.home_name = home.get("name")
@@ -40,13 +197,10 @@ class Directions:
         except:
             print("Format non correct for locations")
 
-    # USE Google shortner
+    # Short link served by dodohome (see shortlink.py)
     def _url_shorten(self, url):
-        data = {'longUrl': url}
-        headers = {'Content-type': 'application/json'}
-        response = requests.post(
-            self._shorturl, data=json.dumps(data), headers=headers).json()
-        return response.get("id")
+        return "{}/s/{}".format(self.__SHORTLINK_BASE,
+                                shortlink.store(self._redis_conn, url))
 
     # Generate URL with GMaps directions
     def _generate_url(self, vehicle, transit_mode=None):
@@ -76,43 +230,146 @@ class Directions:
         else:
             data = "!4m2!4m1!3e{}".format(transportation.get(vehicle))
         u = self.__URL.format(self.home_name, self.work_name, data)
-        return self._url_shorten(u)
+        if not (u in self._urls):
+            self._urls[u] = self._url_shorten(u)
+        return self._urls[u]
 
-    # Wrapper for _get_directions
-    def get_directions(self,
+    # Route and url for a vehicle: bicycling falls back to walking
+    def _vehicle_route(self,
                        vehicle,
-                       arrival_time,
+                       t,
                        transit_routing_preference=None,
                        traffic_model=None):
         mode = TRAVEL_MODES[vehicle]
         transit_mode = None
-        infos = None
+        fallback = False
         # Bus and train are "transit" vehicle
-        if mode is "transit":
+        if mode == "transit":
             transit_mode = vehicle
 
-        # Get directions information and dispatch to the parser
-        directions, url = self._get_directions(
+        result = self._get_directions(
             mode,
-            arrival_time,
+            t,
             transit_mode=transit_mode,
-            transit_routing_preference=transit_routing_preference)
-        if mode == "walking":
-            infos = self.get_walk(directions)
-        elif mode == "bicycling":
-            # Bicycling is not always available
-            fallback = False
-            if not directions:
-                directions = self.get_walk(directions)
-                fallback = True
-            infos = self.get_bicycle(directions, fallback)
-        elif mode == "driving":
-            infos = self.get_car(directions)
-        elif mode == "transit" and transit_mode == "bus":
-            infos = self.get_bus(directions)
-        elif mode == "transit" and transit_mode == "train":
-            infos = self.get_train(directions)
-        return infos, url
+            transit_routing_preference=transit_routing_preference,
+            traffic_model=traffic_model or "best_guess")
+        if not result and mode == "bicycling":
+            # Bicycling is not always available: use the walking route
+            result = self._get_directions("walking", t)
+            fallback = True
+        if not result:
+            return None
+        directions, url = result
+        return directions, url, fallback
+
+    def _summary(self, vehicle, directions, fallback):
+        mode = TRAVEL_MODES[vehicle]
+        transit_mode = vehicle if mode == "transit" else None
+        infos = parse_route(directions, mode, transit_mode, fallback)
+        print("|" + "-" * 80)
+        print("Directions for {}: {}".format(vehicle.upper(), infos))
+        if self.__PPRINT:
+            pprint(directions)
+        return infos
+
+    # Wrapper for _get_directions
+    def get_directions(self,
+                       vehicle,
+                       arrival_time,
+                       transit_routing_preference=None,
+                       traffic_model=None):
+        route = self._vehicle_route(vehicle, arrival_time,
+                                    transit_routing_preference, traffic_model)
+        if route is None:
+            return None, None
+        directions, url, fallback = route
+        return self._summary(vehicle, directions, fallback), url
+
+    # Latest departure (unix time) that still arrives by deadline (unix
+    # time), with the route as get_directions returns it.
+    # Transit: Google already answers with the last connection arriving by
+    # the deadline. Walking/bicycling: the travel time does not change.
+    # Driving: the travel time depends on the traffic, so the departure is
+    # bracketed then bisected on the cache buckets (every probe is a cached
+    # route, at most _MAX_PROBES of them).
+    # None when there is no route at all.
+    def latest_departure(self,
+                         vehicle,
+                         deadline,
+                         transit_routing_preference=None,
+                         traffic_model=None):
+        mode = TRAVEL_MODES[vehicle]
+        step = self._CACHE_BUCKET[mode]
+        now = int(time.time())
+        routes = {}
+
+        def probe(t):
+            t = max(t - t % step, now - now % step)
+            if t not in routes:
+                routes[t] = self._vehicle_route(
+                    vehicle, t, transit_routing_preference, traffic_model)
+            return t, routes[t]
+
+        if mode != "driving":
+            # Asked for the exact deadline, only the cache key is rounded
+            route = self._vehicle_route(vehicle, deadline,
+                                        transit_routing_preference,
+                                        traffic_model)
+            if route is None:
+                return None
+            directions, url, fallback = route
+            infos = self._summary(vehicle, directions, fallback)
+            leg = directions["legs"][0]
+            if mode == "transit" and "departure_time" in leg:
+                return leg["departure_time"]["value"], infos, url
+            return deadline - infos.duration * 60, infos, url
+
+        if probe(deadline)[1] is None:
+            return None
+
+        # Traffic is only known from now on: the travel time of a probe is
+        # the one leaving at the probe time (or now)
+        def arrival(t):
+            t, route = probe(t)
+            if route is None:
+                return math.inf
+            return max(t, now) + route_duration(route[0])
+
+        # First guess: leave the travel time at the deadline before it
+        t, (directions, _, _) = probe(deadline)
+        t, _ = probe(deadline - route_duration(directions))
+        # Bracket: lo arrives on time, hi does not
+        width = step
+        if arrival(t) <= deadline:
+            lo, hi = t, t + width
+            while arrival(hi) <= deadline and len(routes) < self._MAX_PROBES:
+                lo, width = hi, width * 2
+                hi = lo + width
+        else:
+            lo, hi = t - width, t
+            while (arrival(lo) > deadline and lo > now
+                   and len(routes) < self._MAX_PROBES):
+                hi, width = lo, width * 2
+                lo = hi - width
+            lo, _ = probe(lo)
+        # Bisect on the buckets
+        while hi - lo > step and len(routes) < self._MAX_PROBES:
+            mid, _ = probe((lo + hi) // 2)
+            if mid in (lo, hi):
+                break
+            if arrival(mid) <= deadline:
+                lo = mid
+            else:
+                hi = mid
+        lo, route = probe(lo)
+        if route is None:
+            return None
+        directions, url, fallback = route
+        # Within a bucket the travel time is taken as constant; too late
+        # even leaving now: leave now
+        departure = max(lo, deadline - route_duration(directions))
+        departure = max(now, min(hi, departure))
+        return departure, self._summary(vehicle, directions, fallback), url
 
     # Call to GMaps API
     # Default parameter:
@@ -124,178 +381,151 @@ class Directions:
                         transit_mode=None,
                         transit_routing_preference=None,
                         traffic_model="best_guess"):
+        with tracing.span("directions",
+                          mode=vehicle,
+                          transit_mode=transit_mode,
+                          preference=transit_routing_preference,
+                          traffic_model=traffic_model):
+            return self._lookup(vehicle, arrival_time, transit_mode,
+                                transit_routing_preference, traffic_model)
+
+    # Cached route, or predicted from the history, or downloaded
+    def _lookup(self, vehicle, arrival_time, transit_mode,
+                transit_routing_preference, traffic_model):
+        url = self._generate_url(vehicle, transit_mode)
+        # Cache keys round the query time down to the bucket of the mode,
+        # the API is asked for the exact time
+        exact = int(googlemaps.convert.time(arrival_time))
+        t = exact - exact % self._CACHE_BUCKET[vehicle]
+        query = (vehicle, t, transit_mode, transit_routing_preference,
+                 traffic_model)
+        key = self._cache_key(*query)
+        cached = self._redis_conn.get(key)
+        if cached:
+            cached = json.loads(cached)
+            if time.time() - cached["fetched"] > self._CACHE_TTL[vehicle]:
+                # Stale: serve it while a fresh copy is downloaded
+                self._revalidate.submit(self._refresh, key, vehicle, exact,
+                                        *query[2:])
+                tracing.annotate(cache="stale")
+            else:
+                tracing.annotate(cache="hit")
+            return cached["route"], url
+        route_id = self._route_id(*query)
+        if vehicle != "transit":
+            route = self._history.predict(route_id,
+                                          self._trip_time(t, vehicle))
+            if route:
+                print("Travel time from history for:", vehicle.upper())
+                tracing.annotate(cache="history")
+                return route, url
+        tracing.annotate(cache="miss")
+        route = self._refresh(key, vehicle, exact, *query[2:])
+        if not route and vehicle != "transit":
+            # API failed or out of quota: any estimate is better than none
+            route = self._history.predict(route_id,
+                                          self._trip_time(t, vehicle),
+                                          confident_only=False)
+            tracing.annotate(fallback=bool(route))
+        if not route:
+            print("No direction found for:", vehicle.upper())
+            return False
+        return route, url
+
+    def _cache_key(self, *query):
+        h = hashlib.sha1(
+            json.dumps([self.home_location, self.work_location] +
+                       list(query)).encode("utf-8")).hexdigest()
+        return self._CACHE_PREFIX + h
+
+    # Same as the cache key, without the time
+    def _route_id(self, vehicle, t, *query):
+        return hashlib.sha1(
+            json.dumps([self.home_location, self.work_location, vehicle] +
+                       list(query)).encode("utf-8")).hexdigest()
+
+    # When the trip of a query happens: transit queries are by arrival,
+    # the others by departure (from now on)
+    def _trip_time(self, t, vehicle):
+        if vehicle == "transit":
+            return t
+        return max(t, int(time.time()))
+
+    # Download the route and store it in the cache (fresh for _CACHE_TTL,
+    # then kept as stale for as long again)
+    def _refresh(self, key, vehicle, t, transit_mode,
+                 transit_routing_preference, traffic_model):
+        # Only one refresh at a time for each route
+        lock_key = "lock:" + key[len("cache:"):]
+        lock = self._redis_conn.lock(lock_key, timeout=60)
+        if not lock.acquire(blocking=False):
+            return self._wait_refresh(key, lock_key)
+        try:
+            try:
+                route = self._fetch(vehicle, t, transit_mode,
+                                    transit_routing_preference, traffic_model)
+            except (googlemaps.exceptions.ApiError,
+                    googlemaps.exceptions.TransportError,
+                    googlemaps.exceptions.Timeout, budget.OverBudget) as e:
+                print("Directions API failed:", e)
+                return False
+            if route:
+                self._redis_conn.set(
+                    key,
+                    json.dumps({
+                        "route": route,
+                        "fetched": time.time()
+                    }),
+                    ex=2 * self._CACHE_TTL[vehicle])
+                self._history.record(
+                    self._route_id(vehicle, t, transit_mode,
+                                   transit_routing_preference, traffic_model),
+                    self._trip_time(t, vehicle), route_duration(route),
+                    route)
+            return route
+        finally:
+            lock.release()
+
+    # Another process/thread is downloading the same route
+    def _wait_refresh(self, key, lock_key):
+        while True:
+            cached = self._redis_conn.get(key)
+            if cached:
+                return json.loads(cached)["route"]
+            if not self._redis_conn.exists(lock_key):
+                return False
+            time.sleep(0.2)
+
+    def _fetch(self, vehicle, t, transit_mode, transit_routing_preference,
+               traffic_model):
         region = "it"
+        self._budget.acquire("maps", budget.BACKGROUND)
         if transit_mode:
-            url = self._generate_url(vehicle, transit_mode)
-            directions = self._gmaps.directions(
-                self.home_location,
-                self.work_location,
-                alternatives=False,
-                region=region,
-                mode=vehicle,
-                transit_routing_preference=transit_routing_preference,
-                transit_mode=transit_mode,
-                arrival_time=arrival_time)
+            with tracing.span("maps api", mode=vehicle), self._api_slots:
+                directions = self._gmaps.directions(
+                    self.home_location,
+                    self.work_location,
+                    alternatives=False,
+                    region=region,
+                    mode=vehicle,
+                    transit_routing_preference=transit_routing_preference,
+                    transit_mode=transit_mode,
+                    arrival_time=t)
         else:
-            url = self._generate_url(vehicle, transit_mode)
-            directions = self._gmaps.directions(
-                self.home_location,
-                self.work_location,
-                alternatives=True,
-                traffic_model=traffic_model,
-                region=region,
-                mode=vehicle,
-                departure_time=arrival_time)
+            with tracing.span("maps api", mode=vehicle), self._api_slots:
+                directions = self._gmaps.directions(
+                    self.home_location,
+                    self.work_location,
+                    alternatives=True,
+                    traffic_model=traffic_model,
+                    region=region,
+                    mode=vehicle,
+                    # Traffic is only available from now on
+                    departure_time=max(t, int(time.time())))
         try:
             # Return the best solution found
             return min(
                 directions,
-                key=lambda x: x.get("legs")[0].get("duration").get("value")
-            ), url
+                key=lambda x: x.get("legs")[0].get("duration").get("value"))
         except (ValueError, TypeError):
-            print("No direction found for:", vehicle.upper())
             return False
-
-    # Return parsed informations from directions
-    def get_bus(self, directions):
-        print("|" + "-" * 80)
-        print("Gettings directions for BUS transit")
-        if self.__PPRINT:
-            pprint(directions)
-        legs = directions.get("legs")[0]
-        departure_time = datetime.fromtimestamp(
-            legs.get("departure_time").get("value")).strftime('%d %b - %H:%M')
-        arrival_time = legs.get("arrival_time").get("text")
-        duration = math.ceil(legs.get("duration").get("value") / 60)
-        steps = directions.get("legs")[0].get("steps")
-        departure_name = None
-        line = None
-        for s in steps:
-            try:
-                transit_details = s.get("transit_details")
-                vehicle = transit_details.get("line").get("vehicle").get(
-                    "name")
-                if "bus" in json.dumps(transit_details.get("line")).lower():
-                    departure_name = transit_details.get("departure_stop").get(
-                        "name")
-                    line = transit_details.get("line").get("short_name")
-                    break
-                if "train" in json.dumps(transit_details.get("line")).lower(
-                ) or "heavy_rail" in json.dumps(transit_details).lower():
-                    departure_name = transit_details.get("departure_stop").get(
-                        "name")
-                    line = transit_details.get("headsign")
-                    vehicle += " (BUS not available)"
-                    break
-            except:
-                pass
-        infos = {
-            "departure_time": departure_time,
-            "departure_name": departure_name,
-            "line": line,
-            "arrival_time": arrival_time,
-            "duration": duration,
-            "vehicle": vehicle,
-        }
-        print("|" + "-" * 80)
-        return infos
-
-    # Return parsed informations from directions
-    def get_train(self, directions):
-        print("|" + "-" * 80)
-        print("Gettings directions for TRAIN transit")
-        if self.__PPRINT:
-            pprint(directions)
-        legs = directions.get("legs")[0]
-        departure_time = datetime.fromtimestamp(
-            legs.get("departure_time").get("value")).strftime('%d %b - %H:%M')
-        arrival_time = legs.get("arrival_time").get("text")
-        duration = math.ceil(legs.get("duration").get("value") / 60)
-        steps = directions.get("legs")[0].get("steps")
-        departure_name = None
-        line = None
-        for s in steps:
-            try:
-                transit_details = s.get("transit_details")
-                vehicle = transit_details.get("line").get("vehicle").get(
-                    "name")
-                if "train" in json.dumps(transit_details.get("line")).lower(
-                ) or "heavy_rail" in json.dumps(transit_details).lower():
-                    departure_name = transit_details.get("departure_stop").get(
-                        "name")
-                    line = transit_details.get("headsign")
-                    break
-            except:
-                pass
-        if not line and departure_time:
-            vehicle += " (BUS not available)"
-            print("NOT TRAIN")
-        infos = {
-            "departure_time": departure_time,
-            "departure_name": departure_name,
-            "line": line,
-            "arrival_time": arrival_time,
-            "duration": duration,
-            "vehicle": vehicle,
-        }
-        print("|" + "-" * 80)
-        return infos
-
-    # Return parsed informations from directions
-    def get_car(self, directions):
-        print("|" + "-" * 80)
-        print("Gettings directions for CAR")
-        if self.__PPRINT:
-            pprint(directions)
-        legs = directions.get("legs")[0]
-        duration = math.ceil(legs.get("duration").get("value") / 60)
-        distance = math.ceil(legs.get("distance").get("value") / 1000)
-        infos = {
-            "duration": duration,
-            "distance": distance,
-            "vehicle": "car",
-            "via": directions.get("summary"),
-        }
-        print("|" + "-" * 80)
-        return infos
-
-    # Return parsed informations from directions
-    def get_walk(self, directions):
-        print("|" + "-" * 80)
-        print("Gettings directions for WALK")
-        if self.__PPRINT:
-            pprint(directions)
-        legs = directions.get("legs")[0]
-        duration = math.ceil(legs.get("duration").get("value") / 60)
-        distance = math.ceil(legs.get("distance").get("value") / 1000)
-        infos = {
-            "duration": duration,
-            "distance": distance,
-            "vehicle": "walking",
-            "via": directions.get("summary"),
-        }
-        print("|" + "-" * 80)
-        return infos
-
-    # Return parsed informations from directions
-    def get_bicycle(self, directions, fallback=True):
-        print("|" + "-" * 80)
-        print("Gettings directions for BICYCLE")
-        if self.__PPRINT:
-            pprint(directions)
-        legs = directions.get("legs")[0]
-        duration = math.ceil(legs.get("duration").get("value") / 60)
-
-        # No walking route founds, use walking info but with less time duration
-        if fallback:
-            duration = int(duration / 1.5)
-
-        distance = math.ceil(legs.get("distance").get("value") / 1000)
-        infos = {
-            "duration": duration,
-            "distance": distance,
-            "vehicle": "bicycle",
-            "via": directions.get("summary"),
-        }
-        print("|" + "-" * 80)
-        return infos
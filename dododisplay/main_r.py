@@ -7,11 +7,15 @@ import radar
 import RPi.GPIO as GPIO
 import session
 import subprocess
+import sys
 import time
 import weather
 from dateutil.parser import parse
 from pprint import pprint
 
+# Seconds between two events refresh: only the changes are downloaded
+REFRESH_TIME = 300
+
 
 def get_event_info(e, home):
     dateT = parse(e.get("start").get("dateTime"))
@@ -145,10 +149,10 @@ def display_daemon(mng, event, lock, actions):
                 i += 5
 
 
-def refresh_daemon(mng, lock):
-    s = session.Session()
+def refresh_daemon(mng, lock, user=None):
+    s = session.Session(user)
     while True:
-        time.sleep(10000)
+        time.sleep(REFRESH_TIME)
         events = s.get_events()
         with lock:
             print("Events updated")
@@ -158,8 +162,10 @@ def refresh_daemon(mng, lock):
 
 
 if __name__ == "__main__":
+    # Optional account email, when several users are logged in
+    user = sys.argv[1] if len(sys.argv) > 1 else None
     try:
-        s = session.Session()
+        s = session.Session(user)
         home_f, _ = s.get_home_location()
         home = {
             "lat": home_f.get("geometry").get("location").get("lat"),
@@ -181,7 +187,6 @@ if __name__ == "__main__":
         ip = subprocess.check_output(cmd, shell=True).decode("utf-8")
         display.OLed().simple_message(ip + "\nDodoHome")
         print(e)
-        import sys
         sys.exit(-1)
 
     event = mp.Event()
@@ -201,7 +206,8 @@ if __name__ == "__main__":
     tasks.append(
         mp.Process(target=radar_daemon, daemon=False, args=(mng, event, lock)))
     tasks.append(
-        mp.Process(target=refresh_daemon, daemon=False, args=(mng, lock)))
+        mp.Process(
+            target=refresh_daemon, daemon=False, args=(mng, lock, user)))
     try:
         list(map(lambda x: x.start(), tasks))
         list(map(lambda x: x.join(), tasks))
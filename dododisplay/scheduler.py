@@ -0,0 +1,89 @@
+import heapq
+import time
+from dateutil.parser import parse
+
+# Re-planning cadence: (seconds left before the event, seconds between two
+# plans). Far events rarely change, traffic matters in the last hours.
+CADENCE = [
+    (2 * 24 * 3600, 12 * 3600),
+    (24 * 3600, 6 * 3600),
+    (6 * 3600, 3600),
+    (2 * 3600, 15 * 60),
+    (0, 5 * 60),
+]
+
+
+def replan_interval(seconds_left):
+    for threshold, interval in CADENCE:
+        if seconds_left > threshold:
+            return interval
+    return CADENCE[-1][1]
+
+
+# Priority queue of the events to plan, ordered by the time of their next
+# plan (ties by start time). Entries of changed or removed events are left
+# in the heap and skipped when popped.
+class Scheduler:
+    def __init__(self):
+        self._heap = []
+        # event id -> (event, start timestamp, due time of its live entry)
+        self._events = {}
+
+    def _start(self, event):
+        return parse(event.get("start").get("dateTime")).timestamp()
+
+    def _push(self, event, start, due):
+        self._events[event.get("id")] = (event, start, due)
+        heapq.heappush(self._heap, (due, start, event.get("id")))
+
+    # Keep the queue in sync with the upcoming events: new or moved events
+    # are planned right away, the missing ones are forgotten
+    def update(self, events, now=None):
+        now = now or time.time()
+        ids = set()
+        for e in events:
+            ids.add(e.get("id"))
+            known = self._events.get(e.get("id"))
+            start = self._start(e)
+            if known is None or known[1] != start or known[0].get(
+                    "end") != e.get("end"):
+                self._push(e, start, now)
+            else:
+                # Same times, keep the schedule with the latest copy
+                self._events[e.get("id")] = (e, start, known[2])
+        for event_id in set(self._events) - ids:
+            del self._events[event_id]
+
+    # Plan the event again later, according to how close it is
+    def reschedule(self, event, now=None):
+        now = now or time.time()
+        start = self._start(event)
+        if start <= now:
+            self._events.pop(event.get("id"), None)
+            return
+        due = min(start, now + replan_interval(start - now))
+        self._push(event, start, due)
+
+    def _live(self, entry):
+        due, start, event_id = entry
+        known = self._events.get(event_id)
+        return known is not None and known[1] == start and known[2] == due
+
+    # Events whose plan is due, nearest event first
+    def pop_due(self, now=None):
+        now = now or time.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if self._live(entry):
+                due.append(self._events[entry[2]][0])
+        return sorted(due, key=self._start)
+
+    # Time of the next plan, None if there is nothing to plan
+    def next_wakeup(self):
+        while self._heap and not self._live(self._heap[0]):
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def __len__(self):
+        return len(self._events)
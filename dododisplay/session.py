@@ -1,4 +1,7 @@
 #!/usr/bin/env python3
+import budget
+import calendar_batch
+import event_store
 import google.oauth2.credentials
 import redis
 import simplejson as json
@@ -6,74 +9,141 @@ from google.auth.transport.requests import AuthorizedSession
 from datetime import datetime, timezone
 from dateutil.parser import parse
 from pprint import pprint
-from requests_oauthlib import OAuth2Session
+from token_broker import TokenBroker
+from urllib.parse import quote
 
 
 # Connect to redis DB using the localhost socket on default port
 class Session():
     _redis_conn = redis.Redis(unix_socket_path="/run/redis/redis.sock")
+    # Calendar requests share the budget with dodohome (see budget.py)
+    _budget = budget.Budget(_redis_conn)
     __REFRESH_URL = "https://www.googleapis.com/oauth2/v4/token"
     __CLIENT_ID = ""
     __CLIENT_SECRET = ""
     __PPRINT = True
     _url_calendars = "https://www.googleapis.com/calendar/v3/calendars/"
+    _path_calendars = "/calendar/v3/calendars/"
+    _url_batch = calendar_batch.BATCH_URL
+    _SESSION_PREFIX = "session:"
+    _USERS_INDEX = "index:users"
+    _TOKENS_INDEX = "index:tokens"
+    _WAKEUP_PREFIX = "daemon:wakeup:"
+    # Calendars changed, queued by the push notifications (dodohome)
+    _QUEUE_PREFIX = "queue:replan:"
     _event_count = -1
     _events = None
 
-    def __init__(self):
+    def __init__(self, user=None):
         try:
             # Retrieve the OAuth token
-            self._session_key = [
-                key.decode("utf-8") for key in self._redis_conn.scan_iter()
-                if "oauth_token" in self._redis_conn.get(key).decode("utf-8")
-            ][0]
-            self._session_data = json.loads(
-                self._redis_conn.get(self._session_key))
+            self._session_key = self._find_session(user)
+            self._session_data = self._load_session(self._session_key)
             self._calendar = self._session_data["default_calendar"]
             self.get_events()
         except:
             print("Session not found!")
             raise IndexError
 
-    def _update_session(self):
-        self._redis_conn.set(self._session_key, json.dumps(self._session_data))
+    # Lookup the session in the index kept by dodohome (redis_session.py):
+    # by account email if given, otherwise any session holding a token
+    def _find_session(self, user=None):
+        if not self._redis_conn.exists(self._TOKENS_INDEX):
+            self._backfill_index()
+        if user:
+            key = self._redis_conn.hget(self._USERS_INDEX, user)
+            keys = [key] if key else []
+        else:
+            keys = sorted(self._redis_conn.smembers(self._TOKENS_INDEX))
+        for key in keys:
+            if self._redis_conn.exists(key):
+                return key.decode("utf-8")
+            # The session expired, drop the stale entries
+            self._redis_conn.srem(self._TOKENS_INDEX, key)
+            if user:
+                self._redis_conn.hdel(self._USERS_INDEX, user)
+        raise IndexError
+
+    # Sessions saved before dodohome kept the index: rebuild it with a scan
+    # of the sessions (only while the index is empty)
+    def _backfill_index(self):
+        pipe = self._redis_conn.pipeline()
+        for key in self._redis_conn.scan_iter(self._SESSION_PREFIX + "*"):
+            try:
+                data = self._read_session(key)[0]
+            except Exception:
+                continue
+            if not ("oauth_token" in data):
+                continue
+            pipe.sadd(self._TOKENS_INDEX, key)
+            user = data.get("username") or {}
+            user_id = user.get("email") or user.get("id")
+            if user_id:
+                pipe.hsetnx(self._USERS_INDEX, user_id, key)
+        if len(pipe):
+            print("Sessions index rebuilt")
+            pipe.execute()
+
+    # Read again the settings changed from the web app (locations, vehicles,
+    # calendar) for long running processes
+    def reload(self):
+        self._session_data = self._load_session(self._session_key)
+        self._calendar = self._session_data["default_calendar"]
+
+    @classmethod
+    def users(cls):
+        return sorted(
+            u.decode("utf-8") for u in cls._redis_conn.hkeys(cls._USERS_INDEX))
+
+    # Sessions are stored either as a single JSON string or as a hash with
+    # one JSON encoded value per key (see dodohome/redis_session.py)
+    def _load_session(self, key):
+        data, self._hash_fields = self._read_session(key)
+        return data
+
+    # (session data, stored as a hash)
+    def _read_session(self, key):
+        if self._redis_conn.type(key) != b"hash":
+            return json.loads(self._redis_conn.get(key)), False
+        fields = self._redis_conn.hgetall(key)
+        fields.pop(b"__refreshed__", None)
+        return {k.decode("utf-8"): json.loads(v)
+                for k, v in fields.items()}, True
+
+    def _update_session(self, *keys):
+        if not self._hash_fields:
+            self._redis_conn.set(self._session_key,
+                                 json.dumps(self._session_data))
+            return
+        # Only touch the changed fields, the web app owns the others
+        self._redis_conn.hmset(
+            self._session_key,
+            {k: json.dumps(self._session_data[k])
+             for k in (keys or self._session_data)})
 
     # If the token is updated sync the DB
     def _token_saver(self, token):
         self._session_data["oauth_token"] = token
-        self._update_session()
+        self._update_session("oauth_token")
+
+    def _token_broker(self):
+        return TokenBroker(self._redis_conn, self.__CLIENT_ID,
+                           self.__CLIENT_SECRET, self.__REFRESH_URL)
 
     def _manual_refresh(self):
-        extra = {
-            "client_id": self.__CLIENT_ID,
-            "client_secret": self.__CLIENT_SECRET,
-        }
-        g = OAuth2Session(
-            self.__CLIENT_ID, token=self._session_data["oauth_token"])
-        # Trigger update
-        g.get("https://www.googleapis.com/oauth2/v1/userinfo")
-        self._token_saver(g.refresh_token(self.__REFRESH_URL, **extra))
-
-    def _automatic_refresh(self):
-        extra = {
-            "client_id": self.__CLIENT_ID,
-            "client_secret": self.__CLIENT_SECRET,
-        }
-        old = self._session_data["oauth_token"]["expires_at"]
-        g = OAuth2Session(
-            self.__CLIENT_ID,
-            token=self._session_data["oauth_token"],
-            auto_refresh_kwargs=extra,
-            auto_refresh_url=self.__REFRESH_URL,
-            token_updater=self._token_saver)
-        g.get("https://www.googleapis.com/oauth2/v1/userinfo")
-        if old < self._session_data["oauth_token"]["expires_at"]:
-            print("Token Updated")
+        self._token_broker().refresh(
+            self._session_key,
+            self._session_data["oauth_token"],
+            self._token_saver,
+            force=True)
 
     # Send the OAuth token to get the credential token
     def _get_credentials(self):
-        self._automatic_refresh()
-        token = self._session_data["oauth_token"]
+        token = self._token_broker().get_token(
+            self._session_key, self._session_data["oauth_token"],
+            self._token_saver)
+        # Keep the token refreshed by another process for the next calls
+        self._session_data["oauth_token"] = token
         credentials = google.oauth2.credentials.Credentials(
             token["access_token"],
             refresh_token=token["refresh_token"],
@@ -81,6 +151,28 @@ class Session():
             client_secret=self.__CLIENT_SECRET)
         return AuthorizedSession(credentials)
 
+    # Next time the planning daemon wakes up (see update_events.py)
+    def set_next_wakeup(self, t):
+        self._redis_conn.set(self._WAKEUP_PREFIX + self._session_key, int(t))
+
+    def get_next_wakeup(self):
+        t = self._redis_conn.get(self._WAKEUP_PREFIX + self._session_key)
+        return int(t) if t else None
+
+    # Wait up to timeout seconds for change notifications: True if the
+    # calendar of the session changed
+    def wait_changes(self, timeout):
+        queue = self._QUEUE_PREFIX + self._session_key
+        # BLPOP waits forever with a 0 timeout
+        item = self._redis_conn.blpop(queue, max(1, int(timeout)))
+        if item is None:
+            return False
+        pipe = self._redis_conn.pipeline()
+        pipe.lrange(queue, 0, -1)
+        pipe.delete(queue)
+        calendars = {item[1]} | set(pipe.execute()[0])
+        return self._calendar.encode("utf-8") in calendars
+
     def get_calendar_id(self):
         return self._calendar
 
@@ -97,34 +189,39 @@ class Session():
             "secondary_vehicle"]
 
     def get_events(self, number_evts=15):
-        now = datetime.utcnow().isoformat() + "Z"
-        authed_session = self._get_credentials()
-        url = self._url_calendars + "{}/events".format(self._calendar)
-        response = authed_session.get(
-            url,
-            params={
-                "maxResults": number_evts,
-                "timeMin": now,
-                "orderBy": "startTime",
-                "singleEvents": "true"
-            }).json()
-
-        # Query could return the current/in progress event, not useful
-        start_date = parse(response["items"][0].get("start").get("dateTime"))
-        # needs to make datetime offset-aware: set timezone
-        if start_date < datetime.now(timezone.utc):
-            response["items"].pop(0)
+        # Incremental sync of the local copy of the calendar, the local copy
+        # is used as is when the budget is over or the sync fails
+        store = event_store.EventStore(self._redis_conn,
+                                         self._session_key, self._calendar)
+        try:
+            store.sync(self._get_credentials(), self._acquire)
+        except (budget.OverBudget, event_store.SyncError) as e:
+            print(e)
+        response = {"items": store.upcoming(number_evts)}
+
+        # The store could return the current/in progress event, not useful
+        if response["items"]:
+            start_date = parse(
+                response["items"][0].get("start").get("dateTime"))
+            # needs to make datetime offset-aware: set timezone
+            if start_date < datetime.now(timezone.utc):
+                response["items"].pop(0)
 
         self._events = response["items"]
         return response["items"]
 
-    # Update the reminder and description for a event
-    def update_event(self, event, time, description=None):
-        # PUT https://www.googleapis.com/calendar/v3/calendars/calendarId/events/eventId
-        headers = {'Content-type': 'application/json'}
-        authed_session = self._get_credentials()
-        url = self._url_calendars + "{}/events/{}".format(
-            self._calendar, event.get("id"))
+    # Background work: leaves the reserved budget to the web app
+    def _acquire(self):
+        self._budget.acquire("calendar", budget.BACKGROUND)
+
+    def _event_path(self, event):
+        return "{}/events/{}".format(quote(self._calendar, safe="@"),
+                                     event.get("id"))
+
+    # Fields of the event that differ from the computed reminder and
+    # description: an empty dict means there is nothing to write
+    def _event_changes(self, event, time, description=None):
+        changes = {}
         reminders = {
             "useDefault": False,
             "overrides": [{
@@ -132,21 +229,79 @@ class Session():
                 "minutes": time
             }]
         }
-        response = authed_session.put(
-            url,
-            data=json.dumps({
-                "start": event.get("start"),
-                "end": event.get("end"),
-                "colorId": event.get("colorId"),
-                "summary": event.get("summary"),
-                "reminders": reminders,
-                "description": description
-            }),
-            headers=headers).json()
+        current = event.get("reminders") or {}
+        if (bool(current.get("useDefault")) or
+                current.get("overrides") != reminders["overrides"]):
+            changes["reminders"] = reminders
+        if (event.get("description") or None) != (description or None):
+            changes["description"] = description
+        return changes
+
+    # Update the reminder and description for a event, only if they changed
+    def update_event(self, event, time, description=None):
+        # PATCH https://www.googleapis.com/calendar/v3/calendars/calendarId/events/eventId
+        changes = self._event_changes(event, time, description)
+        if not changes:
+            return event
+        headers = {'Content-type': 'application/json'}
+        authed_session = self._get_credentials()
+        url = self._url_calendars + self._event_path(event)
+        self._acquire()
+        response = authed_session.patch(
+            url, data=json.dumps(changes), headers=headers).json()
         if self.__PPRINT:
             pprint(response)
         return response
 
+    # Same as update_event for a list of (event, time, description), sent as
+    # batch requests: returns the updated events (or errors) in order
+    def update_events(self, updates):
+        results = [e for e, _, _ in updates]
+        pending = []
+        for i, (e, t, d) in enumerate(updates):
+            changes = self._event_changes(e, t, d)
+            if changes:
+                pending.append((i, e, changes))
+        print("Events to update: {}/{}".format(len(pending), len(updates)))
+        if not pending:
+            return results
+        authed_session = self._get_credentials()
+        for i in range(0, len(pending), calendar_batch.BATCH_SIZE):
+            chunk = pending[i:i + calendar_batch.BATCH_SIZE]
+            content_type, payload = calendar_batch.encode_requests([
+                ("PATCH", self._path_calendars + self._event_path(e), c)
+                for _, e, c in chunk
+            ])
+            # Every call of a batch counts against the quota
+            try:
+                for _ in chunk:
+                    self._acquire()
+            except budget.OverBudget as e:
+                print("Batch update skipped:", e)
+                for j, _, _ in chunk:
+                    results[j] = {"error": str(e)}
+                continue
+            response = authed_session.post(
+                self._url_batch,
+                data=payload,
+                headers={"Content-Type": content_type})
+            if response.status_code != 200:
+                print("Batch update failed:", response.status_code)
+                for j, _, _ in chunk:
+                    results[j] = {"error": response.text}
+                continue
+            parsed = calendar_batch.decode_responses(
+                response.headers["Content-Type"], response.text, len(chunk))
+            for (j, e, _), r in zip(chunk, parsed):
+                if r is None or r[0] >= 300:
+                    print("Event update failed:", e.get("id"), r)
+                    results[j] = r[1] if r else {"error": "no response"}
+                else:
+                    results[j] = r[1]
+        if self.__PPRINT:
+            pprint(results)
+        return results
+
     def get_next_event(self):
         if self._events is None:
             self.get_events()
@@ -0,0 +1,68 @@
+import simplejson as json
+import time
+from requests_oauthlib import OAuth2Session
+
+# Shared between dodohome and dododisplay: keep both copies in sync
+# (per session keys, see the keyspace layout in dodohome/redis_session.py)
+TOKEN_PREFIX = "cache:oauth:"
+LOCK_PREFIX = "lock:oauth:"
+# Refresh the access token this many seconds before it expires
+EXPIRY_MARGIN = 120
+# Upper bound for a refresh request (and for waiting on another process)
+LOCK_TIMEOUT = 30
+
+
+# Hand out OAuth tokens shared by every process using a session: the last
+# token is cached in redis until shortly before it expires and a refresh
+# happens at most once per expiry under a redis lock, so the web app and the
+# display never race on the same refresh token.
+class TokenBroker:
+    def __init__(self, redis, client_id, client_secret, refresh_url):
+        self._redis = redis
+        self._client_id = client_id
+        self._client_secret = client_secret
+        self._refresh_url = refresh_url
+
+    def _is_fresh(self, token):
+        return token.get("expires_at", 0) - EXPIRY_MARGIN > time.time()
+
+    def _cached(self, session_key):
+        val = self._redis.get(TOKEN_PREFIX + session_key)
+        if val is None:
+            return None
+        token = json.loads(val)
+        return token if self._is_fresh(token) else None
+
+    # Return a token valid for at least EXPIRY_MARGIN seconds; token_saver is
+    # called only when this process performed the refresh
+    def get_token(self, session_key, token, token_saver):
+        if self._is_fresh(token):
+            return token
+        cached = self._cached(session_key)
+        if cached:
+            return cached
+        return self.refresh(session_key, token, token_saver)
+
+    def refresh(self, session_key, token, token_saver, force=False):
+        lock = self._redis.lock(LOCK_PREFIX + session_key, timeout=LOCK_TIMEOUT)
+        locked = lock.acquire(blocking_timeout=LOCK_TIMEOUT)
+        try:
+            # Someone else may have refreshed while we were waiting
+            cached = None if force else self._cached(session_key)
+            if cached:
+                return cached
+            g = OAuth2Session(self._client_id, token=token)
+            token = g.refresh_token(
+                self._refresh_url,
+                client_id=self._client_id,
+                client_secret=self._client_secret)
+            print("Token Updated")
+            ttl = int(token["expires_at"] - time.time() - EXPIRY_MARGIN)
+            if ttl > 0:
+                self._redis.set(
+                    TOKEN_PREFIX + session_key, json.dumps(token), ex=ttl)
+            token_saver(token)
+            return token
+        finally:
+            if locked:
+                lock.release()
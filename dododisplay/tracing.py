@@ -0,0 +1,135 @@
+import itertools
+import os
+import simplejson as json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Lightweight tracing of the planning run: spans nest per thread (a task
+# handed to a thread pool with wrap() keeps the span that submitted it as
+# parent) and are exported as a Chrome trace, to open in chrome://tracing
+# or Perfetto, or as JSON lines
+_local = threading.local()
+_lock = threading.Lock()
+_ids = itertools.count(1)
+_spans = []
+
+
+class Span:
+    __slots__ = ("id", "parent", "name", "attrs", "thread", "start", "end")
+
+    def __init__(self, name, parent, attrs):
+        self.id = next(_ids)
+        self.parent = parent.id if parent else None
+        self.name = name
+        self.attrs = attrs
+        self.thread = threading.get_ident()
+        self.start = time.perf_counter()
+        self.end = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    @property
+    def duration(self):
+        return (self.end or time.perf_counter()) - self.start
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def current():
+    stack = _stack()
+    return stack[-1] if stack else getattr(_local, "parent", None)
+
+
+@contextmanager
+def span(name, **attrs):
+    s = Span(name, current(), attrs)
+    _stack().append(s)
+    try:
+        yield s
+    except Exception as e:
+        s.set(error=repr(e))
+        raise
+    finally:
+        s.end = time.perf_counter()
+        _stack().pop()
+        with _lock:
+            _spans.append(s)
+
+
+# Attributes for the innermost span of the thread, if any
+def annotate(**attrs):
+    s = current()
+    if s is not None:
+        s.set(**attrs)
+
+
+# f running in another thread as a child of the current span
+def wrap(f):
+    parent = current()
+
+    def wrapper(*args, **kwargs):
+        previous = getattr(_local, "parent", None)
+        _local.parent = parent
+        try:
+            return f(*args, **kwargs)
+        finally:
+            _local.parent = previous
+
+    return wrapper
+
+
+# Finished spans, and forget them
+def collect():
+    global _spans
+    with _lock:
+        spans, _spans = _spans, []
+    return spans
+
+
+# Chrome trace (.json) or JSON lines (.jsonl, appended) of the spans
+def export(path, spans):
+    if path.endswith(".jsonl"):
+        with open(path, "a") as f:
+            for s in spans:
+                f.write(json.dumps({
+                    "id": s.id,
+                    "parent": s.parent,
+                    "name": s.name,
+                    "thread": s.thread,
+                    "start": s.start,
+                    "duration": s.duration,
+                    "attrs": s.attrs
+                }, default=str) + "\n")
+        return
+    with open(path, "w") as f:
+        json.dump({
+            "displayTimeUnit": "ms",
+            "traceEvents": [{
+                "name": s.name,
+                "ph": "X",
+                "ts": s.start * 1e6,
+                "dur": s.duration * 1e6,
+                "pid": os.getpid(),
+                "tid": s.thread,
+                "args": dict(s.attrs, id=s.id, parent=s.parent)
+            } for s in spans]
+        }, f, default=str)
+
+
+# Calls, total and slowest time of every span name
+def report(spans):
+    stats = defaultdict(list)
+    for s in spans:
+        stats[s.name].append(s.duration)
+    print("{:<20}{:>8}{:>12}{:>12}".format("span", "calls", "total (s)",
+                                           "max (s)"))
+    for name, durations in stats.items():
+        print("{:<20}{:>8}{:>12.3f}{:>12.3f}".format(
+            name, len(durations), sum(durations), max(durations)))
@@ -0,0 +1,98 @@
+import os
+import simplejson as json
+import sqlite3
+import threading
+import time
+
+DB_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "travel_times.db")
+# Observations older than this many weeks are dropped
+HISTORY_WEEKS = 8
+# A prediction is trusted with enough recent observations of the same hour
+# of the week that agree with each other
+MIN_SAMPLES = 4
+STALE_AFTER = 14 * 24 * 3600
+MAX_SPREAD = 0.25
+# Planning is pessimistic: 80% of the trips took less than this
+QUANTILE = 0.8
+
+
+def hour_of_week(t):
+    tm = time.localtime(t)
+    return tm.tm_wday * 24 + tm.tm_hour
+
+
+# q-quantile of sorted values, linearly interpolated
+def quantile(values, q):
+    pos = (len(values) - 1) * q
+    i = int(pos)
+    if i + 1 == len(values):
+        return values[i]
+    return values[i] + (values[i + 1] - values[i]) * (pos - i)
+
+
+# Travel times observed for each route (a query without its time), by hour
+# of the week, in a local SQLite file. The last route downloaded is kept so
+# a prediction can be shown as a route.
+class TravelTimes:
+    def __init__(self, path=DB_PATH):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS observations (
+                    route TEXT, hour INTEGER, observed INTEGER,
+                    duration INTEGER);
+                CREATE INDEX IF NOT EXISTS observations_route
+                    ON observations (route, hour);
+                CREATE TABLE IF NOT EXISTS routes (
+                    route TEXT PRIMARY KEY, body TEXT);
+            """)
+
+    # t: when the trip happens, duration in seconds
+    def record(self, route_id, t, duration, route):
+        with self._lock, self._db:
+            self._db.execute("INSERT INTO observations VALUES (?, ?, ?, ?)",
+                             (route_id, hour_of_week(t), int(time.time()),
+                              int(duration)))
+            self._db.execute("INSERT OR REPLACE INTO routes VALUES (?, ?)",
+                             (route_id, json.dumps(route)))
+            self._db.execute(
+                "DELETE FROM observations WHERE observed < ?",
+                (int(time.time()) - HISTORY_WEEKS * 7 * 24 * 3600, ))
+
+    # (duration quantile, confident) for a trip at time t, None without data
+    def estimate(self, route_id, t, q=QUANTILE):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT observed, duration FROM observations "
+                "WHERE route = ? AND hour = ?",
+                (route_id, hour_of_week(t))).fetchall()
+        if not rows:
+            return None
+        durations = sorted(d for _, d in rows)
+        value = quantile(durations, q)
+        median = quantile(durations, 0.5)
+        confident = (
+            len(rows) >= MIN_SAMPLES
+            and time.time() - max(o for o, _ in rows) < STALE_AFTER
+            and quantile(durations, 0.9) - quantile(durations, 0.1) <=
+            MAX_SPREAD * median)
+        return int(round(value)), confident
+
+    # Last route downloaded with the estimated travel time in place of its
+    # own. Only confident estimates unless any is good (the API failed).
+    def predict(self, route_id, t, confident_only=True):
+        estimate = self.estimate(route_id, t)
+        if estimate is None or (confident_only and not estimate[1]):
+            return None
+        with self._lock:
+            row = self._db.execute("SELECT body FROM routes WHERE route = ?",
+                                   (route_id, )).fetchone()
+        if row is None:
+            return None
+        route = json.loads(row[0])
+        leg = route["legs"][0]
+        leg["duration"] = {"value": estimate[0]}
+        leg.pop("duration_in_traffic", None)
+        return route
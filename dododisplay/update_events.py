@@ -1,14 +1,37 @@
 #!/usr/bin/env python3
 import session
 import directions
+import math
+import scheduler
+import sys
+import threading
+import tracing
 import weather
+import weather_rules
 import time
-from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from dateutil.parser import parse
 from pprint import pprint
 
 # Debug print
 PPRINT = False
+# Events planned at the same time
+PLANNING_WORKERS = 4
+# Ask the directions of the usual route (primary vehicle, good weather) while
+# the weather is downloaded and checked; dropped when the weather is bad
+SPECULATIVE_DIRECTIONS = True
+# Spans of every run: Chrome trace (.json) or JSON lines (.jsonl), None to
+# disable (update_events.py --trace FILE)
+TRACE_FILE = None
+# Empiric time (minutes) for wake up routine
+PADDING_WAKE_UP = 40
+# Minutes of bonus to arrive before the event starts
+ARRIVAL_MARGIN = 5
+# Daemon mode: seconds between two calendar syncs (only the changes are
+# downloaded) and number of upcoming events kept planned
+DAEMON_SYNC = 300
+DAEMON_EVENTS = 15
 TRAVEL_MODES = {
     "car": "driving",
     "bus": "transit",
@@ -18,179 +41,258 @@ TRAVEL_MODES = {
 }
 
 
-# Clouds check (%)
-# Rain check (volume for last 3h in mm), "light/medium rain", "rain"
-# Wind check (m/s)
-# Snow check (volume for last 3h in mm)
-# Temp check (C)
-def is_bad_weather(vehicle, work, home, e):
+# Speculative directions of plan_events (kept apart from the planning
+# workers that wait on them)
+SPECULATION = ThreadPoolExecutor(max_workers=8)
+
+
+# Forecasts at both locations when the event starts and ends
+def event_forecasts(work, home, e):
     w = weather.Weather()
     start_time = parse(e.get("start").get("dateTime"))
     end_time = parse(e.get("end").get("dateTime"))
     work_location = {"lat": work.get("lat"), "lng": work.get("lng")}
     home_location = {"lat": home.get("lat"), "lng": home.get("lng")}
-    forecasts = []
-    is_bad = False
-    vehicle = TRAVEL_MODES[vehicle]
+    forecasts = [
+        w.get_forecast(work_location, start_time),
+        w.get_forecast(home_location, start_time),
+        w.get_forecast(work_location, end_time),
+        w.get_forecast(home_location, end_time),
+    ]
+    if PPRINT:
+        list(map(pprint, forecasts))
+    return forecasts
 
-    # Get all weather information for both locations and times
-    home_start_fc = w.get_forecast(work_location, start_time)
-    forecasts.append(home_start_fc)
 
-    work_start_fc = w.get_forecast(home_location, start_time)
-    forecasts.append(work_start_fc)
+# Bad weather verdicts for every event and vehicle at once (rules in
+# weather_rules.py): {(event id, vehicle): rule fired or None}
+def weather_verdicts(events, vehicles, work, home):
+    if not events:
+        return {}
+    with tracing.span("weather rules", events=len(events)):
+        packed = weather_rules.pack(
+            [event_forecasts(work, home, e) for e in events])
+        _, fired = weather_rules.evaluate(
+            packed, [TRAVEL_MODES[v] for v in vehicles])
+    return {(e.get("id"), v): fired[i, j]
+            for i, e in enumerate(events) for j, v in enumerate(vehicles)}
 
-    work_end_fc = w.get_forecast(work_location, end_time)
-    forecasts.append(work_end_fc)
 
-    home_end_fc = w.get_forecast(home_location, end_time)
-    forecasts.append(home_end_fc)
+def is_bad_weather(vehicle, work, home, e):
+    rule = weather_verdicts([e], [vehicle], work, home)[(e.get("id"),
+                                                          vehicle)]
+    if rule:
+        print("Bad weather for {}: {}".format(vehicle, rule))
+    return bool(rule)
 
-    if PPRINT:
-        pprint(home_start_fc)
-        pprint(work_start_fc)
-        pprint(work_end_fc)
-        pprint(home_end_fc)
-
-    # BAD: medium rain, heavy snow, powerful wind, prohibitive temps
-    if vehicle == "walking":
-        if all(
-                bool(f.get("snow")) and f.get("snow").get("3h") > 3
-                for f in forecasts):
-            is_bad = True
-        if all(f.get("temp").get("temp") < 5 for f in forecasts) or any(
-                f.get("temp").get("temp") > 30 for f in forecasts):
-            is_bad = True
-        if any("rain" in f.get("stat")
-               for f in forecasts) and all(not ("light" in f.get("stat"))
-                                           for f in forecasts):
-            is_bad = True
-        if any(
-                bool(f.get("rain")) and f.get("rain").get("3h") > 5
-                for f in forecasts):
-            is_bad = True
-        if all(
-                f.get("wind").get("speed") > 10 and f.get("clouds") > 80
-                for f in forecasts):
-            is_bad = True
-
-    # BAD: snow, prohibitive temps, all not light rain, clouds with wind (possibile storm)
-    if vehicle == "bicycling":
-        if all(
-                bool(f.get("snow")) and f.get("snow").get("3h") > 1
-                for f in forecasts):
-            is_bad = True
-        if all(f.get("temp").get("temp") < 0 for f in forecasts) or any(
-                f.get("temp").get("temp") > 35 for f in forecasts):
-            is_bad = True
-        if any("rain" in f.get("stat")
-               for f in forecasts) and all(not ("light" in f.get("stat"))
-                                           for f in forecasts):
-            is_bad = True
-        if any(
-                bool(f.get("rain")) and f.get("rain").get("3h") > 1
-                for f in forecasts):
-            is_bad = True
-        if all(
-                f.get("wind").get("speed") > 5 and f.get("clouds") > 80
-                for f in forecasts):
-            is_bad = True
-
-    # BAD: reschedule traffic
-    if vehicle == "driving":
-        if all(
-                bool(f.get("snow")) and f.get("snow").get("3h") > 4
-                for f in forecasts):
-            is_bad = True
-        if any("rain" in f.get("stat")
-               for f in forecasts) and all(not ("light" in f.get("stat"))
-                                           for f in forecasts):
-            is_bad = True
-        if any(
-                bool(f.get("rain")) and f.get("rain").get("3h") > 1
-                for f in forecasts):
-            is_bad = True
-
-    # BAD: avoid walking from home/work to station/stop
-    if vehicle == "transit":
-        if any("rain" in f.get("stat")
-               for f in forecasts) and all(not ("light" in f.get("stat"))
-                                           for f in forecasts):
-            is_bad = True
-        if any(
-                bool(f.get("rain")) and f.get("rain").get("3h") > 3
-                for f in forecasts):
-            is_bad = True
-
-    return is_bad
-
-
-def find_optimal(event, primary, secondary, work, home, directions):
-    PADDING = timedelta(minutes=65)  # UTC+1 plus 5 minutes of bonus
-    start_date = parse(event.get("start").get("dateTime"))
-    if is_bad_weather(primary, work, home, event):
-        # If bad weather traffic model is pessismistic
-        if primary == "driving":
-            start_direction = time.time()
-            d, url = directions.get_directions(
-                primary, start_date - PADDING, traffic_model="pessimistic")
-            print("Get directions time:", time.time() - start_direction)
-        # If bad weather use less_walking parameter
-        if primary == "bus" or primary == "train":
-            start_direction = time.time()
-            d, url = directions.get_directions(
-                primary,
-                start_date - PADDING,
-                transit_routing_preference="less_walking")
-            print("Get directions time:", time.time() - start_direction)
-        # If bad weather switch to the second vehicle choice
-        if primary == "male" or primary == "bicycle":
-            if is_bad_weather(secondary, work, home, event):
-                # Evaluate timing for the second choice
-                if secondary == "bus" or secondary == "train":
-                    start_direction = time.time()
-                    d, url = directions.get_directions(
-                        secondary,
-                        start_date - PADDING,
-                        transit_routing_preference="less_walking")
-                    print("Get directions time:",
-                          time.time() - start_direction)
-                else:
-                    start_direction = time.time()
-                    d, url = directions.get_directions(
-                        secondary,
-                        start_date - PADDING,
-                        traffic_model="pessimistic")
-                    print("Get directions time:",
-                          time.time() - start_direction)
-            else:
-                start_direction = time.time()
-                d, url = directions.get_directions(secondary,
-                                                   start_date - PADDING)
-                print("Get directions time:", time.time() - start_direction)
-    else:
+
+# Directions parameters used when the weather is bad for a vehicle
+def bad_weather_params(vehicle):
+    # Bad weather: avoid walking to the station/stop
+    if TRAVEL_MODES[vehicle] == "transit":
+        return {"transit_routing_preference": "less_walking"}
+    # Bad weather: traffic model is pessimistic
+    return {"traffic_model": "pessimistic"}
+
+
+# Vehicle and directions parameters for the weather verdicts: is_bad is
+# called for the secondary vehicle only if its verdict matters
+def choose_route(primary, secondary, is_bad):
+    if not is_bad(primary):
         # Weather is good!
-        start_direction = time.time()
-        d, url = directions.get_directions(primary, start_date - PADDING)
-        print("Get directions time:", time.time() - start_direction)
-    return d, url
+        return primary, {}
+    if TRAVEL_MODES[primary] in ("driving", "transit"):
+        return primary, bad_weather_params(primary)
+    # If bad weather switch to the second vehicle choice
+    if not is_bad(secondary):
+        return secondary, {}
+    # Evaluate timing for the second choice
+    return secondary, bad_weather_params(secondary)
 
 
-if __name__ == "__main__":
-    start_main = time.time()
-    print("Getting info...")
-    session_data = session.Session()
-    PADDING_WAKE_UP = 40
+# Latest arrival (unix time) at an event
+def event_deadline(event):
+    start_date = parse(event.get("start").get("dateTime"))
+    return int(start_date.timestamp()) - ARRIVAL_MARGIN * 60
+
+
+def search_departure(directions, vehicle, deadline, params):
+    with tracing.span("departure search",
+                      vehicle=vehicle,
+                      mode=TRAVEL_MODES[vehicle],
+                      **params):
+        return directions.latest_departure(vehicle, deadline, **params)
+
+
+# Latest departure (unix time) arriving on time at the event, with its
+# route and url (None without any route). speculated: the search of the
+# usual route (see SPECULATIVE_DIRECTIONS) started before the verdicts were
+# known, as captured returns it.
+def find_optimal(event,
+                 primary,
+                 secondary,
+                 work,
+                 home,
+                 directions,
+                 verdicts=None,
+                 speculated=None):
+
+    # Use the precomputed weather verdicts if any
+    def is_bad(vehicle):
+        if verdicts is None:
+            return is_bad_weather(vehicle, work, home, event)
+        return bool(verdicts[(event.get("id"), vehicle)])
+
+    vehicle, params = choose_route(primary, secondary, is_bad)
+    if speculated is not None:
+        if vehicle == primary and not params:
+            result, log = speculated.result()
+            print(log, end="")
+            return result
+        # Bad weather: the usual route is dropped (if already running, it is
+        # just discarded)
+        speculated.cancel()
+    return search_departure(directions, vehicle, event_deadline(event),
+                            params)
+
+
+# Reminder (minutes before the event) and description for an event, None
+# if no route could be found
+def plan_event(e,
+               primary,
+               secondary,
+               work,
+               home,
+               directions,
+               verdicts,
+               speculated=None):
+    with tracing.span("plan event", event=e.get("id")):
+        return _plan_event(e, primary, secondary, work, home, directions,
+                           verdicts, speculated)
+
+
+def _plan_event(e, primary, secondary, work, home, directions, verdicts,
+                speculated):
     w = weather.Weather()
+    description = ""
+    start_date = e.get("start").get("dateTime")
+    # Use weather ad GMaps API to find the best solution
+    with tracing.span("find optimal", primary=primary, secondary=secondary):
+        optimal = find_optimal(e, primary, secondary, work, home, directions,
+                               verdicts, speculated)
+    if optimal is None:
+        print("No route for:", e.get("summary"))
+        return None
+    departure, d, url = optimal
+
+    # Wake up before the latest departure still arriving on time
+    # PADDING: empiric time for wake up routine
+    reminder = math.ceil((parse(start_date).timestamp() - departure) /
+                         60) + PADDING_WAKE_UP
+
+    ww = w.get_forecast(work, parse(start_date))
+    wh = w.get_forecast(home, parse(start_date) - timedelta(minutes=reminder))
+
+    # Create the description string
+    with tracing.span("description"):
+        for i, value in d.items():
+            description += "<b>{}</b>: {}\n".format(
+                i.replace("_", " ").title(), value)
+        description += "<b>Weather at work</b>: {}, {} °C\n".format(
+            ww.get("stat"),
+            ww.get("temp").get("temp"))
+        description += "<b>Weather at home</b>: {}, {} °C\n".format(
+            wh.get("stat"),
+            wh.get("temp").get("temp"))
+        description += "<b>URL</b>: {}".format(url)
+    return e, reminder, description
+
 
-    # Get events and session info
-    start_get_events = time.time()
-    events = session_data.get_events(3)
-    print("Get Events time:", time.time() - start_get_events)
+# Keeps what each worker thread prints aside, so that the log of every event
+# is written out in order once the event is planned
+class OrderedOutput:
+    def __init__(self, stream):
+        self._stream = stream
+        self._buffers = {}
+
+    def write(self, data):
+        buf = self._buffers.get(threading.get_ident())
+        if buf is None:
+            return self._stream.write(data)
+        buf.append(data)
+        return len(data)
+
+    def flush(self):
+        self._stream.flush()
+
+    def run(self, f, *args):
+        buf = []
+        self._buffers[threading.get_ident()] = buf
+        try:
+            return f(*args), "".join(buf)
+        finally:
+            del self._buffers[threading.get_ident()]
+
+
+# Run f keeping aside what it prints if the output is being ordered:
+# returns its result and the log
+def captured(f, *args):
+    if isinstance(sys.stdout, OrderedOutput):
+        return sys.stdout.run(f, *args)
+    return f(*args), ""
+
+
+# Plan all the events concurrently: weather, directions and their URLs are
+# fetched for several events at a time (each API caps its own concurrency,
+# see Weather and Directions), results and logs come back in event order
+def plan_events(events, primary, secondary, work, home, directions):
+    out = OrderedOutput(sys.stdout)
+    sys.stdout = out
+    updates = []
+    try:
+        # The usual route of every event, while the weather is checked
+        speculated = {}
+        if SPECULATIVE_DIRECTIONS:
+            speculated = {
+                e.get("id"): SPECULATION.submit(
+                    captured, tracing.wrap(search_departure), directions,
+                    primary, event_deadline(e), {})
+                for e in events
+            }
+
+        # Download the forecasts of both locations at the same time
+        w = weather.Weather()
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            list(
+                pool.map(
+                    tracing.wrap(
+                        lambda loc: w.get_forecast(loc, datetime.utcnow())),
+                    [work, home]))
+
+        # Weather rules evaluated for all the events in one pass
+        verdicts = weather_verdicts(events, [primary, secondary], work, home)
+
+        with ThreadPoolExecutor(max_workers=PLANNING_WORKERS) as pool:
+            tasks = [
+                pool.submit(out.run, tracing.wrap(plan_event), e, primary,
+                            secondary, work, home, directions, verdicts,
+                            speculated.get(e.get("id")))
+                for e in events
+            ]
+            for t in tasks:
+                update, log = t.result()
+                out.write(log)
+                if update:
+                    updates.append(update)
+    finally:
+        sys.stdout = out._stream
+    return updates
+
+
+# Work and home coordinates (with their names) of the session
+def get_locations(session_data):
     work_full, work_name = session_data.get_work_location()
     home_full, home_name = session_data.get_home_location()
-    primary_vehicle, secondary_vehicle = session_data.get_vehicles()
-
     work_location = {
         "lat": work_full.get("geometry").get("location").get("lat"),
         "lng": work_full.get("geometry").get("location").get("lng"),
@@ -201,41 +303,107 @@ if __name__ == "__main__":
         "lng": home_full.get("geometry").get("location").get("lng"),
         "name": home_name
     }
-    # init direction with default locations
-    directions = directions.Directions(work_location, home_location)
-
-    for e in events:
-        description = ""
-        start_date = e.get("start").get("dateTime")
-        start_find_optimal = time.time()
-        # Use weather ad GMaps API to find the best solution
-        d, url = find_optimal(e, primary_vehicle, secondary_vehicle,
-                              work_location, home_location, directions)
-        print("Find optimal time: ", time.time() - start_find_optimal)
-
-        # PADDING: empiric time for wake up routine
-        reminder = d.get("duration") + PADDING_WAKE_UP
-
-        start_weather = time.time()
-        ww = w.get_forecast(work_location, parse(start_date))
-        print("Get weather time:", time.time() - start_weather)
-        wh = w.get_forecast(
-            home_location, parse(start_date) - timedelta(minutes=reminder))
-
-        # Create the description string
-        for i in d:
-            description += "<b>{}</b>: {}\n".format(
-                i.replace("_", " ").title(), d.get(i))
-        description += "<b>Weather at work</b>: {}, {} °C\n".format(
-            ww.get("stat"),
-            ww.get("temp").get("temp"))
-        description += "<b>Weather at home</b>: {}, {} °C\n".format(
-            wh.get("stat"),
-            wh.get("temp").get("temp"))
-        description += "<b>URL</b>: {}".format(url)
+    return work_location, home_location
+
+
+def main(user=None, number_evts=3):
+    print("Getting info...")
+    with tracing.span("main", user=user):
+        with tracing.span("session load"):
+            session_data = session.Session(user)
+
+        # Get events and session info
+        with tracing.span("event fetch"):
+            events = session_data.get_events(number_evts)
+        work_location, home_location = get_locations(session_data)
+        primary_vehicle, secondary_vehicle = session_data.get_vehicles()
+
+        # init direction with default locations
+        d = directions.Directions(work_location, home_location)
+
+        with tracing.span("planning", events=len(events)):
+            updates = plan_events(events, primary_vehicle, secondary_vehicle,
+                                  work_location, home_location, d)
 
-        start_event_update = time.time()
-        session_data.update_event(e, reminder, description=description)
-        print("Event update time:", time.time() - start_event_update)
+        # Send all the updates at once
+        with tracing.span("event update", events=len(updates)):
+            session_data.update_events(updates)
 
-    print("Main time: ", time.time() - start_main)
+
+# Print the time spent in every span and write them to TRACE_FILE
+def flush_trace(report=False):
+    spans = tracing.collect()
+    if report:
+        tracing.report(spans)
+    if TRACE_FILE:
+        tracing.export(TRACE_FILE, spans)
+
+
+# Long running planner: session, tokens, HTTP connections and caches stay
+# warm, every event is planned again on its own cadence (see scheduler.py)
+# and the calendar is synced every DAEMON_SYNC seconds or when dodohome
+# receives a change notification
+def daemon(user=None):
+    session_data = session.Session(user)
+    queue = scheduler.Scheduler()
+    settings = None
+    next_sync = 0
+    while True:
+        now = time.time()
+        if now >= next_sync:
+            next_sync = now + DAEMON_SYNC
+            try:
+                session_data.reload()
+                with tracing.span("event fetch"):
+                    events = session_data.get_events(DAEMON_EVENTS)
+                # New locations or vehicles: plan everything again
+                if settings != (get_locations(session_data),
+                                session_data.get_vehicles()):
+                    settings = (get_locations(session_data),
+                                session_data.get_vehicles())
+                    (work, home), (primary, secondary) = settings
+                    d = directions.Directions(work, home)
+                    queue = scheduler.Scheduler()
+                queue.update(events, now)
+            except Exception as e:
+                print("Calendar sync failed:", e)
+
+        due = queue.pop_due(now)
+        if due:
+            print("Planning {} events".format(len(due)))
+            try:
+                with tracing.span("planning", events=len(due)):
+                    updates = plan_events(due, primary, secondary, work,
+                                          home, d)
+                with tracing.span("event update", events=len(updates)):
+                    session_data.update_events(updates)
+            except Exception as e:
+                print("Planning failed:", e)
+            flush_trace()
+            for e in due:
+                queue.reschedule(e)
+
+        wakeup = queue.next_wakeup()
+        if wakeup is None or wakeup > next_sync:
+            wakeup = next_sync
+        session_data.set_next_wakeup(wakeup)
+        print("Next wake up:", datetime.fromtimestamp(wakeup))
+        # A push notification for the calendar wakes the daemon up early:
+        # the sync brings only the changes, the moved events are planned
+        if session_data.wait_changes(wakeup - time.time()):
+            print("Calendar changed")
+            next_sync = 0
+
+
+# update_events.py [--trace FILE] [--daemon] [account email]
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args and args[0] == "--trace":
+        TRACE_FILE = args[1]
+        args = args[2:]
+    if args and args[0] == "--daemon":
+        # Optional account email, when several users are logged in
+        daemon(args[1] if len(args) > 1 else None)
+    else:
+        main(args[0] if args else None)
+        flush_trace(report=True)
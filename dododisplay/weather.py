@@ -1,18 +1,40 @@
+import bisect
+import budget
+import calendar
 import pyowm
+import redis
+import threading
+import time as _time
+import tracing
+
+# Slots of the 5 days forecast are 3 hours apart
+SLOT = 3 * 3600
 
 
 class Weather:
     __OWM_KEY = ""
+    # Seconds a downloaded forecast (or current weather) is reused
+    _FORECAST_TTL = 1800
+    _WEATHER_TTL = 600
+    # Shared by every instance: rounded (lat, lng) -> (expiration, times,
+    # weathers), with the forecast slots sorted by reference time
+    _forecasts = {}
+    _weathers = {}
+    _locks = {}
+    _lock = threading.Lock()
+    # Concurrent requests to OpenWeatherMap
+    _api_slots = threading.BoundedSemaphore(2)
+    # Requests budget shared by every process (see budget.py): when it is
+    # over the expired forecasts are still used
+    _budget = budget.Budget(
+        redis.Redis(unix_socket_path="/run/redis/redis.sock"))
 
     def __init__(self):
         # Init API library
         self._owm = pyowm.OWM(self.__OWM_KEY)
 
-    # Get actual weather for a location
-    def get_weather(self, loc):
-        obs = self._owm.weather_at_coords(loc["lat"], loc["lng"])
-        w = obs.get_weather()
-        weather = {
+    def _to_dict(self, w):
+        return {
             "clouds": w.get_clouds(),
             "rain": w.get_rain(),
             "snow": w.get_snow(),
@@ -20,26 +42,75 @@ class Weather:
             "temp": w.get_temperature(unit='celsius'),
             "stat": w.get_detailed_status()
         }
-        return weather
+
+    # Whether a request can be made, False to keep using the stale entry
+    def _take(self, stale):
+        try:
+            self._budget.acquire("owm", budget.BACKGROUND)
+            return True
+        except budget.OverBudget as e:
+            if stale is None:
+                raise
+            print("Using stale weather:", e)
+            tracing.annotate(cache="stale")
+            return False
+
+    def _key(self, loc):
+        return (round(loc["lat"], 3), round(loc["lng"], 3))
+
+    # One download at a time for each location, the others wait for it
+    def _key_lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    # Get actual weather for a location
+    def get_weather(self, loc):
+        key = self._key(loc)
+        with tracing.span("weather", kind="current"), self._key_lock(key):
+            entry = self._weathers.get(key)
+            tracing.annotate(cache="hit")
+            if (entry is None or entry[0] < _time.time()) and self._take(
+                    entry):
+                tracing.annotate(cache="miss")
+                with self._api_slots:
+                    obs = self._owm.weather_at_coords(loc["lat"], loc["lng"])
+                entry = (_time.time() + self._WEATHER_TTL,
+                         self._to_dict(obs.get_weather()))
+                self._weathers[key] = entry
+        return entry[1]
+
+    def _get_slots(self, loc):
+        key = self._key(loc)
+        with tracing.span("weather", kind="forecast"), self._key_lock(key):
+            entry = self._forecasts.get(key)
+            tracing.annotate(cache="hit")
+            if (entry is None or entry[0] < _time.time()) and self._take(
+                    entry):
+                tracing.annotate(cache="miss")
+                with self._api_slots:
+                    fc = self._owm.three_hours_forecast_at_coords(
+                        loc["lat"], loc["lng"])
+                weathers = sorted(
+                    fc.get_forecast().get_weathers(),
+                    key=lambda w: w.get_reference_time())
+                entry = (_time.time() + self._FORECAST_TTL,
+                         [w.get_reference_time() for w in weathers],
+                         [self._to_dict(w) for w in weathers])
+                self._forecasts[key] = entry
+        return entry[1], entry[2]
 
     # Get forecast for a location in from a specific time range
     def get_forecast(self, loc, time):
-        try:
-            fc = self._owm.three_hours_forecast_at_coords(
-                loc["lat"], loc["lng"])
-            w = fc.get_weather_at(time)
-            weather = {
-                "clouds": w.get_clouds(),
-                "rain": w.get_rain(),
-                "snow": w.get_snow(),
-                "wind": w.get_wind(),
-                "temp": w.get_temperature(unit='celsius'),
-                "stat": w.get_detailed_status()
-            }
-        except pyowm.exceptions.not_found_error.NotFoundError:
-            # If time range is in the presente the library will return an error
-            # if is present use the get_weather function
+        times, weathers = self._get_slots(loc)
+        # Naive datetimes are UTC
+        t = calendar.timegm(time.utctimetuple())
+        if not times or t > times[-1] + SLOT:
             print("Forecast not found for {} at {}".format(loc, time))
-            weather = self.get_weather(loc)
-        finally:
-            return weather
+            return self.get_weather(loc)
+        # Before the first slot (the present): the first slot is the closest
+        i = bisect.bisect_left(times, t)
+        if i == 0:
+            return weathers[0]
+        if i == len(times) or t - times[i - 1] <= times[i] - t:
+            return weathers[i - 1]
+        return weathers[i]
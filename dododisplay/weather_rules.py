@@ -0,0 +1,88 @@
+import numpy as np
+
+# Forecast features packed for the evaluation, in this order
+FEATURES = ("snow", "rain", "temp", "wind", "clouds", "is_rain", "is_light")
+OPS = {">": np.greater, "<": np.less, "==": np.equal}
+
+# Per travel mode rules, the mode is bad as soon as one rule fires.
+# A rule fires when all its terms hold. A term is (quantifier, conditions):
+# the (feature, op, threshold) conditions are and-ed on every forecast of an
+# event, then "any"/"all" combines the forecasts.
+# Clouds (%), rain and snow (volume for last 3h in mm), wind (m/s), temp (C)
+RULES = {
+    # BAD: medium rain, heavy snow, powerful wind, prohibitive temps
+    "walking": [
+        ("snow", [("all", [("snow", ">", 3)])]),
+        ("cold", [("all", [("temp", "<", 5)])]),
+        ("hot", [("any", [("temp", ">", 30)])]),
+        ("rain", [("any", [("is_rain", "==", 1)]),
+                  ("all", [("is_light", "==", 0)])]),
+        ("heavy rain", [("any", [("rain", ">", 5)])]),
+        ("storm", [("all", [("wind", ">", 10), ("clouds", ">", 80)])]),
+    ],
+    # BAD: snow, prohibitive temps, all not light rain, clouds with wind
+    # (possibile storm)
+    "bicycling": [
+        ("snow", [("all", [("snow", ">", 1)])]),
+        ("cold", [("all", [("temp", "<", 0)])]),
+        ("hot", [("any", [("temp", ">", 35)])]),
+        ("rain", [("any", [("is_rain", "==", 1)]),
+                  ("all", [("is_light", "==", 0)])]),
+        ("heavy rain", [("any", [("rain", ">", 1)])]),
+        ("storm", [("all", [("wind", ">", 5), ("clouds", ">", 80)])]),
+    ],
+    # BAD: reschedule traffic
+    "driving": [
+        ("snow", [("all", [("snow", ">", 4)])]),
+        ("rain", [("any", [("is_rain", "==", 1)]),
+                  ("all", [("is_light", "==", 0)])]),
+        ("heavy rain", [("any", [("rain", ">", 1)])]),
+    ],
+    # BAD: avoid walking from home/work to station/stop
+    "transit": [
+        ("rain", [("any", [("is_rain", "==", 1)]),
+                  ("all", [("is_light", "==", 0)])]),
+        ("heavy rain", [("any", [("rain", ">", 3)])]),
+    ],
+}
+
+
+def _features(f):
+    stat = f.get("stat") or ""
+    return ((f.get("snow") or {}).get("3h") or 0,
+            (f.get("rain") or {}).get("3h") or 0,
+            f.get("temp").get("temp"),
+            f.get("wind").get("speed") or 0,
+            f.get("clouds") or 0,
+            "rain" in stat,
+            "light" in stat)
+
+
+# forecasts: one list of forecast dicts (as returned by Weather) per event,
+# all of the same length -> array of shape (events, forecasts, features)
+def pack(forecasts):
+    return np.array([[_features(f) for f in fs] for fs in forecasts],
+                    dtype=float).reshape(len(forecasts), -1, len(FEATURES))
+
+
+def _term(packed, quantifier, conditions):
+    mask = np.ones(packed.shape[:2], dtype=bool)
+    for feature, op, threshold in conditions:
+        mask &= OPS[op](packed[:, :, FEATURES.index(feature)], threshold)
+    return mask.any(axis=1) if quantifier == "any" else mask.all(axis=1)
+
+
+# Evaluate every rule of the given travel modes over all the events at once:
+# returns the (events, modes) matrix of bad weather verdicts and, for each
+# cell, the name of the first rule that fired (None if the weather is good)
+def evaluate(packed, modes):
+    bad = np.zeros((packed.shape[0], len(modes)), dtype=bool)
+    fired = np.full(bad.shape, None, dtype=object)
+    for j, mode in enumerate(modes):
+        for name, terms in RULES[mode]:
+            mask = np.ones(packed.shape[0], dtype=bool)
+            for quantifier, conditions in terms:
+                mask &= _term(packed, quantifier, conditions)
+            fired[mask & ~bad[:, j], j] = name
+            bad[:, j] |= mask
+    return bad, fired
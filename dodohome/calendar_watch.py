@@ -0,0 +1,109 @@
+import secrets
+import time
+from urllib.parse import quote
+from uuid import uuid4
+
+CHANNEL_PREFIX = "channel:"
+# Calendars changed for a session, consumed by the dododisplay daemon
+QUEUE_PREFIX = "queue:replan:"
+URL_WATCH = "https://www.googleapis.com/calendar/v3/calendars/{}/events/watch"
+URL_STOP = "https://www.googleapis.com/calendar/v3/channels/stop"
+# Lifetime asked for a channel (Google may shorten it) and how long before
+# its expiration it is renewed
+CHANNEL_TTL = 7 * 24 * 3600
+RENEW_MARGIN = 24 * 3600
+QUEUE_TTL = 24 * 3600
+
+
+def _decode(channel):
+    return {k.decode("utf-8"): v.decode("utf-8") for k, v in channel.items()}
+
+
+# Channel currently watching the calendar of a session, if any
+def current_channel(redis, watch_key):
+    channel_id = redis.get(watch_key)
+    if channel_id is None:
+        return None
+    channel = redis.hgetall(CHANNEL_PREFIX + channel_id.decode("utf-8"))
+    return _decode(channel) if channel else None
+
+
+# Ask Google to post a notification to address for every change of the
+# calendar: a new channel is opened when the calendar changes or the current
+# one is about to expire. watch_key is the per session cache holding the id.
+def watch(redis, authed_session, session_key, watch_key, calendar_id,
+          address):
+    channel = current_channel(redis, watch_key)
+    if (channel and channel["calendar"] == calendar_id
+            and int(channel["expiration"]) > time.time() + RENEW_MARGIN):
+        return channel
+    channel_id = str(uuid4())
+    token = secrets.token_urlsafe(24)
+    response = authed_session.post(
+        URL_WATCH.format(quote(calendar_id, safe="@")),
+        json={
+            "id": channel_id,
+            "type": "web_hook",
+            "address": address,
+            "token": token,
+            "params": {
+                "ttl": str(CHANNEL_TTL)
+            }
+        })
+    response.raise_for_status()
+    body = response.json()
+    # Google answers with the expiration in milliseconds
+    expiration = int(body.get("expiration", 0)) // 1000 or int(
+        time.time() + CHANNEL_TTL)
+    new = {
+        "id": channel_id,
+        "session": session_key,
+        "calendar": calendar_id,
+        "token": token,
+        "resource": body.get("resourceId", ""),
+        "expiration": str(expiration)
+    }
+    ttl = max(1, expiration - int(time.time()))
+    pipe = redis.pipeline()
+    pipe.hmset(CHANNEL_PREFIX + channel_id, new)
+    pipe.expire(CHANNEL_PREFIX + channel_id, ttl)
+    pipe.set(watch_key, channel_id, ex=ttl)
+    pipe.execute()
+    if channel:
+        stop(redis, authed_session, channel)
+    return new
+
+
+# Close a channel, it is forgotten even if Google does not know it anymore
+def stop(redis, authed_session, channel):
+    redis.delete(CHANNEL_PREFIX + channel["id"])
+    authed_session.post(
+        URL_STOP, json={
+            "id": channel["id"],
+            "resourceId": channel["resource"]
+        })
+
+
+# Handle a notification (the X-Goog-* headers): the changed calendar is
+# queued for the session owning the channel. Returns False for unknown
+# channels or wrong tokens.
+def notify(redis, channel_id, token, state):
+    channel = redis.hgetall(CHANNEL_PREFIX + (channel_id or ""))
+    if not channel:
+        return False
+    channel = _decode(channel)
+    if not secrets.compare_digest(channel["token"], token or ""):
+        return False
+    # "sync" only confirms the channel was opened
+    if state == "sync":
+        return True
+    # The session is gone (expired): nobody plans its events anymore
+    if not redis.exists(channel["session"]):
+        redis.delete(CHANNEL_PREFIX + channel["id"])
+        return False
+    queue = QUEUE_PREFIX + channel["session"]
+    pipe = redis.pipeline()
+    pipe.rpush(queue, channel["calendar"])
+    pipe.expire(queue, QUEUE_TTL)
+    pipe.execute()
+    return True
@@ -1,16 +1,54 @@
 from flask import (Flask, render_template, request, redirect, url_for, jsonify,
-                   session)
+                   session, copy_current_request_context, abort, Response)
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from support_calendar import (get_latest, token_saver, get_user,
                               get_directions, get_work_location,
-                              get_calendar_list)
+                              get_calendar_list, watch_calendar,
+                              unwatch_calendar, session_calendar_keys)
 from requests_oauthlib import OAuth2Session
 from redis_session import RedisSessionInterface
-import googlemaps
+from geocache import GeoCache
+from maps_pool import MapsPool, PoolExhausted
+from budget import Budget, OverBudget
+import calendar_watch
+import metrics
+import shortlink
+import time
 
 app = Flask(__name__)
 app.config["APPLICATION_NAME"] = "dodohome"
 app.config.from_envvar("FLASK_CONFIG_FILE")
-app.session_interface = RedisSessionInterface()
+app.session_interface = RedisSessionInterface(
+    hash_fields=app.config.get("SESSION_HASH_FIELDS", False))
+# Latency of the requests, of the session load/save and of the outbound
+# HTTP calls, served on /metrics
+metrics.instrument_app(app)
+metrics.instrument_http()
+metrics.instrument_methods(app.session_interface, "redis",
+                           ("open_session", "save_session", "invalidate"))
+# Request budget of the Google APIs, shared with dododisplay: the limits of
+# the settings are published in redis and enforced by every process
+budget = Budget(
+    app.session_interface.redis,
+    limits={
+        "maps": (app.config.get("GOOGLEMAPS_QPS", 10),
+                 app.config.get("GOOGLEMAPS_DAILY_BUDGET")),
+        "calendar": (app.config.get("CALENDAR_QPS", 10),
+                     app.config.get("CALENDAR_DAILY_BUDGET")),
+    })
+app.extensions["budget"] = budget
+gmaps_pool = MapsPool(
+    app.config["GOOGLEMAPS_KEY"],
+    budget,
+    size=app.config.get("GOOGLEMAPS_POOL_SIZE", 4),
+    # A request does not wait for a client past its deadline
+    borrow_timeout=app.config.get("OUTBOUND_DEADLINE", 10))
+geocache = GeoCache(
+    app.session_interface.redis,
+    geocode_ttl=app.config.get("GEOCODE_TTL", 30 * 24 * 3600),
+    geolocate_ttl=app.config.get("GEOLOCATE_TTL", 24 * 3600))
+# Bounded pool for the independent outbound calls of a request
+outbound = ThreadPoolExecutor(max_workers=app.config.get("OUTBOUND_WORKERS", 8))
 
 # ON DEBUG --------
 import os
@@ -25,20 +63,65 @@ def session_management():
     session.permanent = True
 
 
+# Result of an outbound call, or default if it misses the request deadline,
+# the API budget is over or no Maps client freed up in time
+def wait_result(future, deadline, default=None):
+    try:
+        return future.result(timeout=max(0, deadline - time.monotonic()))
+    except TimeoutError:
+        future.cancel()
+        return default
+    except (OverBudget, PoolExhausted) as e:
+        print(e)
+        return default
+
+
+# Open (or renew) the push channel of the calendar, if a public webhook
+# address is configured
+def watch_default_calendar():
+    if app.config.get("WEBHOOK_URL") and "default_calendar" in session:
+        try:
+            watch_calendar(app.config["WEBHOOK_URL"])
+        except Exception as e:
+            print("Calendar watch failed:", e)
+
+
+# Close the push channel before the session is removed, so Google stops
+# posting notifications for it, then remove the session with its calendar
+# keys
+def invalidate_session():
+    if "oauth_token" in session:
+        try:
+            unwatch_calendar()
+        except Exception as e:
+            print("Calendar unwatch failed:", e)
+    app.session_interface.invalidate(session, session_calendar_keys())
+
+
 @app.route("/")
 def index():
     if "oauth_token" in session:
         get_user()
+        watch_default_calendar()
         if "page" in request.args:
             page = request.args["page"]
             if page == "vehicles":
                 return render_template(
                     "index.html", vehicles=app.config["VEHICLES"])
             elif page == "maps":
-                gmaps = googlemaps.Client(key=app.config["GOOGLEMAPS_KEY"])
-                location_work_full, location_work = get_work_location(gmaps)
+                gmaps = geocache.client(gmaps_pool, request.remote_addr)
+                deadline = time.monotonic() + app.config.get(
+                    "OUTBOUND_DEADLINE", 10)
+                # Calendar/geocoding and geolocation run concurrently
+                work = outbound.submit(
+                    copy_current_request_context(get_work_location), gmaps)
                 # Approx home location city by IP
-                location_home = gmaps.geolocate()["location"]
+                home = outbound.submit(gmaps.geolocate)
+                location_work_full, location_work = wait_result(
+                    work, deadline, (-1, -1))
+                location_home = (wait_result(home, deadline) or {
+                    "location": app.config.get("DEFAULT_LOCATION")
+                })["location"]
                 if location_work == -1 or location_work_full == -1:
                     # Ask the user to insert his WORK location
                     return render_template(
@@ -104,9 +187,7 @@ def restart():
 @app.route("/oauth2callback")
 def oauth2callback():
     if not ("code" in request.args):
-        session.clear()
-        import redis
-        redis.StrictRedis(host="localhost", port=6379, db=0).flushdb()
+        invalidate_session()
         g = OAuth2Session(
             app.config["CLIENT_ID"],
             scope=app.config["SCOPES"],
@@ -136,6 +217,7 @@ def select_calendar():
     # Double check all parameters
     if cal in session["calendars"].split(","):
         session["default_calendar"] = cal
+        watch_default_calendar()
         return redirect(url_for("index", page="vehicles"))
     else:
         return redirect(url_for("index"))
@@ -184,11 +266,10 @@ def set_home_location():
         session["location_home"] = location_home
         session["location_home_full"] = location_home_full
         if "location_work" in session and "location_home" in session:
-            gmaps = googlemaps.Client(key=app.config["GOOGLEMAPS_KEY"])
             # Get informations directly from gmaps
             directions_result = get_directions(session["location_home_full"],
                                                session["location_work_full"],
-                                               gmaps)
+                                               gmaps_pool)
             if directions_result != -1:
                 """ replicate the informations to client (no python API to do
                     this without double quering)
@@ -220,10 +301,9 @@ def set_work_location():
         session["location_work"] = location_work
         session["location_work_full"] = location_work_full
         if "location_home" in session:
-            gmaps = googlemaps.Client(key=app.config["GOOGLEMAPS_KEY"])
             directions_result = get_directions(session["location_home_full"],
                                                session["location_work_full"],
-                                               gmaps)
+                                               gmaps_pool)
             if directions_result != -1:
                 """ replicate the informations to client (no python API to do
                     this without double quering)
@@ -243,11 +323,46 @@ def set_work_location():
         return redirect(url_for("index"))
 
 
+# Short links generated by dododisplay for the directions: ids are content
+# hashes, so a link never changes and can be cached forever
+@app.route("/s/<link_id>")
+def short_link(link_id):
+    url = shortlink.resolve(app.session_interface.redis, link_id)
+    if url is None:
+        abort(404)
+    response = redirect(url, code=301)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+# Calendar push notifications: only the changed calendar of the channel
+# owner is queued, dododisplay then syncs it and plans the moved events
+@app.route("/calendar/notify", methods=["POST"])
+def calendar_notify():
+    if not calendar_watch.notify(
+            app.session_interface.redis,
+            request.headers.get("X-Goog-Channel-ID"),
+            request.headers.get("X-Goog-Channel-Token"),
+            request.headers.get("X-Goog-Resource-State")):
+        abort(404)
+    return "", 204
+
+
+# Prometheus text format
+@app.route("/metrics")
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+# Requests left today for each API
+@app.route("/budget")
+def remaining_budget():
+    return jsonify(budget.remaining())
+
+
 @app.route("/logout")
 def logout():
-    session.clear()
-    import redis
-    redis.StrictRedis(host="localhost", port=6379, db=0).flushdb()
+    invalidate_session()
     return jsonify(success=True), 200
 
 
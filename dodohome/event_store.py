@@ -0,0 +1,137 @@
+import simplejson as json
+import time
+from dateutil.parser import parse
+
+# Shared between dodohome and dododisplay: keep both copies in sync
+EVENTS_PREFIX = "cache:events:"
+URL_CALENDARS = "https://www.googleapis.com/calendar/v3/calendars/"
+# Keys of calendars nobody syncs anymore expire after this many seconds
+EVENTS_TTL = 30 * 24 * 3600
+# Events started more than this many seconds ago are dropped at every sync
+EVENTS_KEEP = 24 * 3600
+# Longest event still in progress we look back for
+MAX_DURATION = 24 * 3600
+
+
+# The answer of a sync can not be applied (no sync token to go on from): the
+# local copy is left as it was
+class SyncError(Exception):
+    pass
+
+
+# Start/end of an event as unix time (all-day events have only a "date")
+def event_time(t):
+    dt = parse(t.get("dateTime") or t.get("date"))
+    if dt.tzinfo is None:
+        return time.mktime(dt.timetuple())
+    return dt.timestamp()
+
+
+# Keys of the local copy of a calendar for a session
+def store_keys(session_key, calendar_id):
+    key = EVENTS_PREFIX + session_key + ":" + calendar_id
+    return key + ":items", key + ":start", key + ":sync"
+
+
+# Every key of the local copies of a session (its calendars are listed in
+# cache:events:session:<sid>), to remove them with the session
+def session_keys(redis, session_key):
+    calendars = EVENTS_PREFIX + session_key
+    keys = [calendars]
+    for calendar_id in redis.smembers(calendars):
+        keys.extend(store_keys(session_key, calendar_id.decode("utf-8")))
+    return keys
+
+
+# Local copy of the events of a calendar kept up to date with the Calendar
+# incremental sync: a hash of event id -> event and a sorted set of event ids
+# by start time, both in redis so the web app and the display share them.
+# Each session has its own copy: a calendar shared with several users is
+# seen by each of them with their own access level.
+class EventStore:
+    def __init__(self, redis, session_key, calendar_id):
+        self._redis = redis
+        self._url = URL_CALENDARS + "{}/events".format(calendar_id)
+        self._calendar_id = calendar_id
+        self._calendars = EVENTS_PREFIX + session_key
+        self._items, self._index, self._sync = store_keys(
+            session_key, calendar_id)
+
+    # Apply the changes reported by Google since the last sync and return the
+    # ids of the changed events. The first sync downloads every upcoming event.
+    # Raises SyncError, without touching the local copy, if Google does not
+    # answer with a sync token.
+    # acquire, if given, is called before every request (API budget).
+    def sync(self, authed_session, acquire=None):
+        token = self._redis.get(self._sync)
+        params = {"singleEvents": "true", "maxResults": 250}
+        if token:
+            params["syncToken"] = token.decode("utf-8")
+        else:
+            params["timeMin"] = time.strftime("%Y-%m-%dT%H:%M:%SZ",
+                                              time.gmtime())
+        pipe = self._redis.pipeline()
+        if not token:
+            pipe.delete(self._items, self._index)
+        changed = []
+        while True:
+            if acquire:
+                acquire()
+            response = authed_session.get(self._url, params=params)
+            if response.status_code == 410:
+                # Sync token no longer valid: start over with a full sync
+                self._redis.delete(self._sync)
+                return self.sync(authed_session, acquire)
+            response.raise_for_status()
+            body = response.json()
+            for e in body.get("items", []):
+                changed.append(e["id"])
+                if e.get("status") == "cancelled":
+                    pipe.hdel(self._items, e["id"])
+                    pipe.zrem(self._index, e["id"])
+                else:
+                    pipe.hset(self._items, e["id"], json.dumps(e))
+                    pipe.execute_command("ZADD", self._index,
+                                         event_time(e["start"]), e["id"])
+            if "nextPageToken" in body:
+                params["pageToken"] = body["nextPageToken"]
+            else:
+                break
+        if not ("nextSyncToken" in body):
+            pipe.reset()
+            raise SyncError("no sync token for " + self._calendar_id)
+        pipe.set(self._sync, body["nextSyncToken"])
+        pipe.sadd(self._calendars, self._calendar_id)
+        for k in (self._items, self._index, self._sync, self._calendars):
+            pipe.expire(k, EVENTS_TTL)
+        pipe.execute()
+        self._drop_old()
+        return changed
+
+    def _drop_old(self):
+        old = self._redis.zrangebyscore(self._index, "-inf",
+                                        time.time() - EVENTS_KEEP)
+        if old:
+            pipe = self._redis.pipeline()
+            pipe.zrem(self._index, *old)
+            pipe.hdel(self._items, *old)
+            pipe.execute()
+
+    # First n events not ended yet ordered by start time, like an events list
+    # with timeMin=now and orderBy=startTime
+    def upcoming(self, n):
+        now = time.time()
+        pipe = self._redis.pipeline()
+        pipe.zrangebyscore(self._index, now - MAX_DURATION, now)
+        pipe.zrangebyscore(self._index, "(" + repr(now), "+inf", start=0, num=n)
+        started, ids = pipe.execute()
+        ids = started + ids
+        if not ids:
+            return []
+        events = [json.loads(e) for e in self._redis.hmget(self._items, ids)
+                  if not (e is None)]
+        return [e for e in events if event_time(e["end"]) > now][:n]
+
+    def get(self, event_id):
+        val = self._redis.hget(self._items, event_id)
+        return None if val is None else json.loads(val)
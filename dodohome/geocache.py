@@ -0,0 +1,94 @@
+import simplejson as json
+import threading
+import time
+from collections import OrderedDict
+
+GEOCODE_PREFIX = "cache:geocode:"
+GEOLOCATE_PREFIX = "cache:geolocate:"
+
+
+# Same address written in different ways maps to the same key
+def normalize_address(address):
+    return ",".join(" ".join(p.split()) for p in address.lower().split(","))
+
+
+# Small thread safe LRU with per entry expiration
+class LRU:
+    def __init__(self, size):
+        self._size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[0] < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.time() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self._size:
+                self._data.popitem(last=False)
+
+
+# Geocoding and geolocation results cached in process and in redis, so that
+# repeated page loads do not consume the Maps quota
+class GeoCache:
+    def __init__(self, redis, geocode_ttl=30 * 24 * 3600,
+                 geolocate_ttl=24 * 3600, size=256):
+        self._redis = redis
+        self._geocode_ttl = geocode_ttl
+        self._geolocate_ttl = geolocate_ttl
+        self._lru = LRU(size)
+
+    # The LRU keeps the JSON text so callers never share (and mutate) the
+    # same objects
+    def _cached(self, key, ttl, fetch):
+        val = self._lru.get(key)
+        if not (val is None):
+            return json.loads(val)
+        val = self._redis.get(key)
+        if val is None:
+            value = fetch()
+            # Do not remember failures
+            if not value:
+                return value
+            val = json.dumps(value)
+            self._redis.set(key, val, ex=ttl)
+        self._lru.set(key, val, ttl)
+        return json.loads(val)
+
+    def geocode(self, gmaps, address):
+        return self._cached(GEOCODE_PREFIX + normalize_address(address),
+                            self._geocode_ttl, lambda: gmaps.geocode(address))
+
+    def geolocate(self, gmaps, ip):
+        return self._cached(GEOLOCATE_PREFIX + str(ip), self._geolocate_ttl,
+                            lambda: gmaps.geolocate())
+
+    # googlemaps.Client look-alike answering geocode/geolocate from the cache
+    def client(self, gmaps, ip):
+        return CachedClient(self, gmaps, ip)
+
+
+class CachedClient:
+    def __init__(self, cache, gmaps, ip):
+        self._cache = cache
+        self._gmaps = gmaps
+        self._ip = ip
+
+    def geocode(self, address):
+        return self._cache.geocode(self._gmaps, address)
+
+    def geolocate(self):
+        return self._cache.geolocate(self._gmaps, self._ip)
+
+    def __getattr__(self, name):
+        return getattr(self._gmaps, name)
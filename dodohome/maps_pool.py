@@ -0,0 +1,81 @@
+import googlemaps
+import queue
+import random
+import threading
+import time
+from budget import INTERACTIVE
+
+
+# App wide googlemaps clients: each one keeps its own HTTP session alive, so
+# requests reuse connections instead of doing a TLS handshake every time.
+class PoolExhausted(Exception):
+    pass
+
+
+# It exposes the googlemaps.Client methods: every call borrows a client
+# (waiting up to borrow_timeout seconds, raises PoolExhausted), waits for
+# the shared "maps" budget (see budget.py, raises OverBudget) and retries
+# with jitter on OVER_QUERY_LIMIT.
+class MapsPool:
+    def __init__(self,
+                 key,
+                 budget,
+                 size=4,
+                 priority=INTERACTIVE,
+                 retries=3,
+                 backoff=0.5,
+                 timeout=10,
+                 borrow_timeout=10):
+        self._key = key
+        self._size = size
+        self._retries = retries
+        self._backoff = backoff
+        self._timeout = timeout
+        self._borrow_timeout = borrow_timeout
+        self._budget = budget
+        self._priority = priority
+        self._clients = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    # Clients are created lazily, the key is validated on first use
+    def _borrow(self):
+        try:
+            return self._clients.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self._size:
+                self._created += 1
+                try:
+                    return googlemaps.Client(
+                        key=self._key,
+                        timeout=self._timeout,
+                        retry_over_query_limit=False)
+                except Exception:
+                    self._created -= 1
+                    raise
+        try:
+            return self._clients.get(timeout=self._borrow_timeout)
+        except queue.Empty:
+            raise PoolExhausted("no Maps client free after {} s".format(
+                self._borrow_timeout))
+
+    def _call(self, name, *args, **kwargs):
+        for attempt in range(self._retries + 1):
+            self._budget.acquire("maps", self._priority)
+            client = self._borrow()
+            try:
+                return getattr(client, name)(*args, **kwargs)
+            except googlemaps.exceptions.ApiError as e:
+                if e.status != "OVER_QUERY_LIMIT" or attempt == self._retries:
+                    raise
+            finally:
+                self._clients.put(client)
+            # Exponential backoff with full jitter
+            time.sleep(random.uniform(0, self._backoff * 2**attempt))
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self._call(name, *args, **kwargs)
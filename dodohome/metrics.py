@@ -0,0 +1,217 @@
+import functools
+import re
+import threading
+import time
+from flask import before_render_template, g, request, template_rendered
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+
+# Seconds, upper bounds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# (host, path prefix) -> upstream of the outbound HTTP calls
+UPSTREAMS = [
+    ("maps.googleapis.com", "/", "maps"),
+    ("www.googleapis.com", "/geolocation/", "maps"),
+    ("www.googleapis.com", "/calendar/", "calendar"),
+    ("www.googleapis.com", "/batch/calendar/", "calendar"),
+    ("www.googleapis.com", "/oauth2/", "oauth"),
+    ("oauth2.googleapis.com", "/", "oauth"),
+]
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(
+        n,
+        str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                          for n, v in zip(names, values)) + "}"
+
+
+# Metrics in the Prometheus text format, kept in process (one set per
+# worker process)
+class Counter:
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *values):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + 1
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.description),
+            "# TYPE {} counter".format(self.name)
+        ]
+        with self._lock:
+            for values, count in sorted(self._values.items()):
+                lines.append("{}{} {}".format(
+                    self.name, _labels(self.labels, values), count))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, description, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> (count per bucket, sum, count)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *values):
+        with self._lock:
+            counts, total, n = self._values.get(
+                values, ([0] * len(self.buckets), 0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[values] = (counts, total + value, n + 1)
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.description),
+            "# TYPE {} histogram".format(self.name)
+        ]
+        names = self.labels + ("le", )
+        with self._lock:
+            for values, (counts, total, n) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append("{}_bucket{} {}".format(
+                        self.name, _labels(names, values + (bound, )),
+                        count))
+                lines.append("{}_bucket{} {}".format(
+                    self.name, _labels(names, values + ("+Inf", )), n))
+                lines.append("{}_sum{} {}".format(
+                    self.name, _labels(self.labels, values), total))
+                lines.append("{}_count{} {}".format(
+                    self.name, _labels(self.labels, values), n))
+        return lines
+
+
+REQUEST_SECONDS = Histogram("dodohome_request_seconds",
+                            "Latency of the requests by route",
+                            ("route", "method", "status"))
+REQUEST_ERRORS = Counter("dodohome_request_errors_total",
+                         "Requests answered with a 5xx status by route",
+                         ("route", "method"))
+UPSTREAM_SECONDS = Histogram(
+    "dodohome_upstream_seconds",
+    "Latency of the calls to redis, the Google APIs and the templates",
+    ("upstream", "call"))
+UPSTREAM_ERRORS = Counter("dodohome_upstream_errors_total",
+                          "Calls to redis and the Google APIs that failed",
+                          ("upstream", "call"))
+METRICS = [REQUEST_SECONDS, REQUEST_ERRORS, UPSTREAM_SECONDS, UPSTREAM_ERRORS]
+
+
+def render():
+    return "\n".join(line for m in METRICS for line in m.render()) + "\n"
+
+
+# Decorator timing the calls of f (and counting its exceptions)
+def timed(upstream, call=None):
+    def decorator(f):
+        name = call or f.__name__
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            except Exception:
+                UPSTREAM_ERRORS.inc(upstream, name)
+                raise
+            finally:
+                UPSTREAM_SECONDS.observe(time.perf_counter() - start,
+                                         upstream, name)
+
+        return wrapper
+
+    return decorator
+
+
+# Time the given methods of an object (the session interface)
+def instrument_methods(obj, upstream, names):
+    for name in names:
+        setattr(obj, name, timed(upstream, name)(getattr(obj, name)))
+
+
+# Upstream and call labels of an HTTP request: calendar and event ids are
+# left out of the path to keep the labels few
+def endpoint(method, url):
+    parts = urlsplit(url)
+    upstream = "other"
+    for host, prefix, name in UPSTREAMS:
+        if parts.hostname == host and parts.path.startswith(prefix):
+            upstream = name
+            break
+    path = re.sub(r"/calendars/[^/]+", "/calendars/*", parts.path)
+    path = re.sub(r"/calendarList/[^/]+", "/calendarList/*", path)
+    path = re.sub(r"/events/[^/]+$", "/events/*", path)
+    return upstream, "{} {}".format(method, path)
+
+
+# Time every outbound HTTP call where it leaves the process: googlemaps,
+# google-auth and requests_oauthlib (token refresh) all go through
+# requests, so the helpers calling each other are never counted twice.
+# Exceptions and 5xx answers are counted as errors.
+def instrument_http():
+    send = HTTPAdapter.send
+    if getattr(send, "timed", False):
+        return
+
+    def timed_send(adapter, http_request, **kwargs):
+        upstream, call = endpoint(http_request.method, http_request.url)
+        start = time.perf_counter()
+        try:
+            response = send(adapter, http_request, **kwargs)
+        except Exception:
+            UPSTREAM_ERRORS.inc(upstream, call)
+            raise
+        finally:
+            UPSTREAM_SECONDS.observe(time.perf_counter() - start, upstream,
+                                     call)
+        if response.status_code >= 500:
+            UPSTREAM_ERRORS.inc(upstream, call)
+        return response
+
+    timed_send.timed = True
+    HTTPAdapter.send = timed_send
+
+
+# Request latency by route (the rule, not the url, to keep the labels few)
+# and template rendering time. Flask saves the session after the request
+# is observed: its time is in the redis upstream only.
+def instrument_app(app):
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        start = g.get("metrics_start")
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            REQUEST_SECONDS.observe(time.perf_counter() - start, route,
+                                    request.method, response.status_code)
+            if response.status_code >= 500:
+                REQUEST_ERRORS.inc(route, request.method)
+        return response
+
+    def start_template(sender, template, context, **extra):
+        g.metrics_template = time.perf_counter()
+
+    def observe_template(sender, template, context, **extra):
+        start = g.pop("metrics_template", None)
+        if start is not None:
+            UPSTREAM_SECONDS.observe(time.perf_counter() - start, "template",
+                                     template.name)
+
+    before_render_template.connect(start_template, app, weak=False)
+    template_rendered.connect(observe_template, app, weak=False)
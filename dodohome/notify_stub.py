@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# Local stand-in for the Calendar push notifications (for tests):
+#   notify_stub.py open <session key> <calendar id>
+#       registers a channel without asking Google, prints its id
+#   notify_stub.py post <channel id> [webhook url] [state]
+#       posts a notification as Google does (state defaults to "exists")
+import calendar_watch
+import requests
+import secrets
+import sys
+import time
+from redis import Redis
+from uuid import uuid4
+
+WEBHOOK_URL = "http://localhost:5000/calendar/notify"
+
+if __name__ == "__main__":
+    redis = Redis(unix_socket_path="/run/redis/redis.sock")
+    if sys.argv[1] == "open":
+        channel_id = str(uuid4())
+        redis.hmset(
+            calendar_watch.CHANNEL_PREFIX + channel_id, {
+                "id": channel_id,
+                "session": sys.argv[2],
+                "calendar": sys.argv[3],
+                "token": secrets.token_urlsafe(24),
+                "resource": "stub",
+                "expiration": str(
+                    int(time.time() + calendar_watch.CHANNEL_TTL))
+            })
+        redis.expire(calendar_watch.CHANNEL_PREFIX + channel_id,
+                     calendar_watch.CHANNEL_TTL)
+        print(channel_id)
+    else:
+        channel_id = sys.argv[2]
+        url = sys.argv[3] if len(sys.argv) > 3 else WEBHOOK_URL
+        state = sys.argv[4] if len(sys.argv) > 4 else "exists"
+        token = redis.hget(calendar_watch.CHANNEL_PREFIX + channel_id, "token")
+        response = requests.post(
+            url,
+            headers={
+                "X-Goog-Channel-ID": channel_id,
+                "X-Goog-Channel-Token": (token or b"").decode("utf-8"),
+                "X-Goog-Resource-ID": "stub",
+                "X-Goog-Resource-State": state,
+                "X-Goog-Message-Number": str(int(time.time()))
+            })
+        print(response.status_code)
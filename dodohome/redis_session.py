@@ -1,13 +1,55 @@
 import simplejson as json
+import time
 from datetime import timedelta
 from uuid import uuid4
 from redis import Redis
+from redis.exceptions import ResponseError
 from werkzeug.datastructures import CallbackDict
 from flask.sessions import SessionInterface, SessionMixin
 
+# Keyspace layout (shared with dododisplay):
+#   session:<sid>                  the sessions
+#   index:*                        index of the authenticated sessions
+#   cache:<name>:...               caches shared by every user
+#   cache:<name>:session:<sid>     caches bound to a single session
+#   cache:events:session:<sid>:*   local copies of the calendars (event_store)
+#   lock:<name>:session:<sid>      locks bound to a single session
+#   channel:<id>                   Calendar push notification channels
+#   queue:replan:session:<sid>     calendars changed, to plan again
+#   daemon:wakeup:session:<sid>    next planning of the dododisplay daemon
+#   link:<id>                      directions short links (shortlink.py)
+#   budget:<api>:*                 API request budgets and limits (budget.py)
+SESSION_PREFIX = "session:"
+CACHE_PREFIX = "cache:"
+LOCK_PREFIX = "lock:"
+WAKEUP_PREFIX = "daemon:wakeup:"
+# Caches and locks removed together with their session
+SESSION_CACHES = ("oauth", "etag", "watch")
+SESSION_LOCKS = ("oauth", )
+# Hash field holding the last time the TTL of a session was pushed to redis
+TTL_FIELD = "__refreshed__"
+# Account email (or Google id) -> session key
+USERS_INDEX = "index:users"
+# Keys of the sessions holding an OAuth token
+TOKENS_INDEX = "index:tokens"
+
+
+def session_cache_key(name, session_key):
+    return CACHE_PREFIX + name + ":" + session_key
+
+
+def session_lock_key(name, session_key):
+    return LOCK_PREFIX + name + ":" + session_key
+
+
+# Account email (or Google id) of a session
+def user_id(session):
+    user = session.get("username") or {}
+    return user.get("email") or user.get("id")
+
 
 class RedisSession(CallbackDict, SessionMixin):
-    def __init__(self, initial=None, sid=None, new=False):
+    def __init__(self, initial=None, sid=None, new=False, refreshed=0):
         def on_update(self):
             self.modified = True
 
@@ -15,19 +57,71 @@ class RedisSession(CallbackDict, SessionMixin):
         self.sid = sid
         self.new = new
         self.modified = False
+        # Keys written or removed since the session was loaded
+        self.dirty = set()
+        # Values as loaded (a copy, hash_fields only), to find the ones
+        # changed in place
+        self.loaded = {}
+        self.refreshed = refreshed
+        # Stored with the old (single string) layout, rewrite it as a hash
+        self.migrate = False
+        # Account the session is indexed under (see _update_index)
+        self.user_id = user_id(self)
+
+    def __setitem__(self, key, value):
+        self.dirty.add(key)
+        CallbackDict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self.dirty.add(key)
+        CallbackDict.__delitem__(self, key)
+
+    def setdefault(self, key, default=None):
+        if not (key in self):
+            self.dirty.add(key)
+        return CallbackDict.setdefault(self, key, default)
+
+    def pop(self, key, *default):
+        if key in self:
+            self.dirty.add(key)
+        return CallbackDict.pop(self, key, *default)
+
+    def popitem(self):
+        item = CallbackDict.popitem(self)
+        self.dirty.add(item[0])
+        return item
+
+    def update(self, *args, **kwargs):
+        changes = dict(*args, **kwargs)
+        self.dirty.update(changes)
+        CallbackDict.update(self, changes)
+
+    def clear(self):
+        self.dirty.update(self.keys())
+        CallbackDict.clear(self)
 
 
 class RedisSessionInterface(SessionInterface):
     serializer = json
     session_class = RedisSession
 
-    def __init__(self, unix_socket_path=None, prefix='session:'):
+    def __init__(self,
+                 unix_socket_path=None,
+                 prefix=SESSION_PREFIX,
+                 hash_fields=False,
+                 ttl_refresh=0.1):
         if unix_socket_path is None:
             redis = Redis(unix_socket_path="/run/redis/redis.sock")
         else:
             redis = Redis(unix_socket_path=unix_socket_path)
         self.redis = redis
         self.prefix = prefix
+        # Store each session key as a field of a redis hash and write back
+        # only the dirty ones
+        self.hash_fields = hash_fields
+        # Fraction of the session lifetime after which an unmodified session
+        # gets its TTL pushed again (hash_fields only)
+        self.ttl_refresh = ttl_refresh
 
     def generate_sid(self):
         return str(uuid4())
@@ -42,27 +136,150 @@ class RedisSessionInterface(SessionInterface):
         if not sid:
             sid = self.generate_sid()
             return self.session_class(sid=sid, new=True)
+        if self.hash_fields:
+            return self._open_hash(sid)
         val = self.redis.get(self.prefix + sid)
         if not (val is None):
             data = self.serializer.loads(val)
             return self.session_class(data, sid=sid)
         return self.session_class(sid=sid, new=True)
 
+    def _open_hash(self, sid):
+        try:
+            fields = self.redis.hgetall(self.prefix + sid)
+        except ResponseError:
+            # WRONGTYPE: the session was saved as a single string
+            data = self.serializer.loads(self.redis.get(self.prefix + sid))
+            session = self.session_class(data, sid=sid)
+            session.dirty.update(session.keys())
+            session.migrate = True
+            return session
+        if not fields:
+            return self.session_class(sid=sid, new=True)
+        refreshed = int(fields.pop(TTL_FIELD.encode("utf-8"), 0))
+        data = {
+            k.decode("utf-8"): self.serializer.loads(v)
+            for k, v in fields.items()
+        }
+        session = self.session_class(data, sid=sid, refreshed=refreshed)
+        # Decoded twice: cheaper than a deep copy
+        session.loaded = {
+            k.decode("utf-8"): self.serializer.loads(v)
+            for k, v in fields.items()
+        }
+        return session
+
     def save_session(self, app, session, response):
         domain = self.get_cookie_domain(app)
         if not session:
-            self.redis.delete(self.prefix + session.sid)
+            # Nothing was ever stored for a new empty session
+            if session.new:
+                return
+            pipe = self.redis.pipeline()
+            pipe.unlink(self.prefix + session.sid)
+            pipe.srem(TOKENS_INDEX, self.prefix + session.sid)
+            pipe.execute()
             if session.modified:
                 response.delete_cookie(app.session_cookie_name, domain=domain)
             return
         redis_exp = self.get_redis_expiration_time(app, session)
         cookie_exp = self.get_expiration_time(app, session)
-        val = self.serializer.dumps(dict(session), ensure_ascii=False, encoding="utf-8")
-        self.redis.setex(self.prefix + session.sid, val,
-                         int(redis_exp.total_seconds()))
+        pipe = self.redis.pipeline()
+        if self.hash_fields:
+            self._find_changes(session)
+        self._update_index(session, pipe)
+        if self.hash_fields:
+            self._save_hash(session, int(redis_exp.total_seconds()), pipe)
+        else:
+            val = self.serializer.dumps(
+                dict(session), ensure_ascii=False, encoding="utf-8")
+            pipe.setex(self.prefix + session.sid, val,
+                       int(redis_exp.total_seconds()))
+        if len(pipe):
+            pipe.execute()
+        session.dirty.clear()
         response.set_cookie(
             app.session_cookie_name,
             session.sid,
             expires=cookie_exp,
             httponly=True,
             domain=domain)
+
+    # Remove the session, its caches, its index entries and the other keys
+    # given by the caller (calendar copies, push channel) without touching
+    # anything else (UNLINK frees the memory in background)
+    def invalidate(self, session, keys=()):
+        key = self.prefix + session.sid
+        keys = [key] + [session_cache_key(n, key) for n in SESSION_CACHES] + [
+            session_lock_key(n, key) for n in SESSION_LOCKS
+        ] + [WAKEUP_PREFIX + key] + list(keys)
+        pipe = self.redis.pipeline()
+        pipe.unlink(*keys)
+        pipe.srem(TOKENS_INDEX, key)
+        for account in {session.user_id, user_id(session)}:
+            self._unindex_user(account, key, pipe)
+        pipe.execute()
+        session.clear()
+        session.dirty.clear()
+
+    # Keep track of the authenticated sessions so that other processes
+    # (dododisplay) can find them without scanning the whole keyspace
+    # (sessions saved before the index existed are added by dododisplay, see
+    # Session._backfill_index)
+    def _update_index(self, session, pipe):
+        if not ({"oauth_token", "username"} & session.dirty):
+            return
+        key = self.prefix + session.sid
+        account = user_id(session)
+        if "oauth_token" in session:
+            pipe.sadd(TOKENS_INDEX, key)
+        else:
+            pipe.srem(TOKENS_INDEX, key)
+            # Without a token the account can not be served from here
+            account = None
+        if account:
+            pipe.hset(USERS_INDEX, account, key)
+        # Account or token removed (or another account): drop the old entry
+        if session.user_id != account:
+            self._unindex_user(session.user_id, key, pipe)
+        session.user_id = account
+
+    # Remove the entry of an account if it still points to the session
+    def _unindex_user(self, account, key, pipe):
+        if account and self.redis.hget(USERS_INDEX, account) == key.encode(
+                "utf-8"):
+            pipe.hdel(USERS_INDEX, account)
+
+    # Mark dirty the values that differ from what was loaded: nested values
+    # changed in place (session["a"]["b"] = 1) never go through __setitem__
+    def _find_changes(self, session):
+        session.dirty.update(k for k, v in session.items()
+                             if not (k in session.loaded)
+                             or session.loaded[k] != v)
+
+    def _save_hash(self, session, ttl, pipe):
+        now = int(time.time())
+        stale = now - session.refreshed >= ttl * self.ttl_refresh
+        if not (session.dirty or stale):
+            # Nothing changed and the TTL is still fresh: skip redis entirely
+            return
+        key = self.prefix + session.sid
+        changed = {
+            k: self.serializer.dumps(
+                session[k], ensure_ascii=False, encoding="utf-8")
+            for k in session.dirty if k in session
+        }
+        removed = [k for k in session.dirty if not (k in session)]
+        for k in removed:
+            session.loaded.pop(k, None)
+        session.loaded.update(
+            (k, self.serializer.loads(v)) for k, v in changed.items())
+        changed[TTL_FIELD] = now
+        if session.migrate:
+            pipe.delete(key)
+        elif removed:
+            pipe.hdel(key, *removed)
+        pipe.hmset(key, changed)
+        pipe.expire(key, ttl)
+        session.refreshed = now
+        session.migrate = False
@@ -0,0 +1,25 @@
+import base64
+import hashlib
+
+# Shared between dodohome and dododisplay: keep both copies in sync
+LINK_PREFIX = "link:"
+# Links not generated again for this many seconds are forgotten
+LINK_TTL = 90 * 24 * 3600
+
+
+# Deterministic id: the same url always gets the same short link
+def link_id(url):
+    digest = hashlib.sha256(url.encode("utf-8")).digest()
+    return base64.urlsafe_b64encode(digest[:6]).decode("ascii")
+
+
+# Stored (or kept alive) for dodohome to resolve it
+def store(redis, url):
+    i = link_id(url)
+    redis.set(LINK_PREFIX + i, url, ex=LINK_TTL)
+    return i
+
+
+def resolve(redis, i):
+    url = redis.get(LINK_PREFIX + i)
+    return None if url is None else url.decode("utf-8")
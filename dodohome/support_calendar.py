@@ -1,6 +1,11 @@
 from flask import session, current_app
-from requests_oauthlib import OAuth2Session
 from google.auth.transport.requests import AuthorizedSession
+import event_store
+from budget import OverBudget
+from maps_pool import PoolExhausted
+import calendar_watch
+from redis_session import session_cache_key
+from token_broker import TokenBroker
 import google.oauth2.credentials
 import simplejson as json
 from datetime import datetime
@@ -13,14 +18,20 @@ TRAVELS_MODE = {
     "train": "transit",
 }
 PADDING_MINUTES = 50
+# Cached responses of conditional requests expire after a day
+ETAG_TTL = 24 * 3600
 
 
 def get_directions(fr, to, gmaps):
     if "location_work" in session and "location_home" in session:
         vehicle = session["primary_vehicle"]
         now = datetime.now()
-        directions_result = gmaps.directions(
-            fr, to, mode=TRAVELS_MODE[vehicle], departure_time=now)
+        try:
+            directions_result = gmaps.directions(
+                fr, to, mode=TRAVELS_MODE[vehicle], departure_time=now)
+        except (OverBudget, PoolExhausted) as e:
+            print(e)
+            return -1
         # Duration in seconds
         duration = directions_result[0]["legs"][0].get("duration").get("value")
         update_calendar(int(duration) / 60 + 20)
@@ -33,6 +44,12 @@ def update_calendar(reminder):
     # PUT https://www.googleapis.com/calendar/v3/users/me/calendarList/calendarId
     headers = {'Content-type': 'application/json'}
     authed_session = get_credentials()
+    try:
+        get_budget().acquire("calendar")
+    except OverBudget as e:
+        # The reminder is updated on the next change of the locations
+        print(e)
+        return None
     url = "https://www.googleapis.com/calendar/v3/users/me/calendarList/{}".format(
         session["default_calendar"])
     reminders = [{"method": "popup", "minutes": (PADDING_MINUTES + reminder)}]
@@ -71,13 +88,12 @@ def get_work_location(gmaps):
 
 
 def get_calendar_list():
-    authed_session = get_credentials()
-    response = authed_session.get(
+    response = conditional_get(
         "https://www.googleapis.com/calendar/v3/users/me/calendarList",
         params={
             "maxResults": 20,
             "showHidden": "true",
-        }).json()
+        })
     real_cals = []
     if not ("calendars" in session):
         session["calendars"] = ",".join([x["id"] for x in response["items"]])
@@ -88,10 +104,9 @@ def get_calendar_list():
 
 
 def get_calendar_info(key=None):
-    authed_session = get_credentials()
-    response = authed_session.get(
+    response = conditional_get(
         "https://www.googleapis.com/calendar/v3/users/me/calendarList/{}".
-        format(session["default_calendar"])).json()
+        format(session["default_calendar"]))
     if key:
         if key in response:
             return response[key]
@@ -100,25 +115,85 @@ def get_calendar_info(key=None):
     return response
 
 
-def get_latest(n, cal=None):
-    now = datetime.utcnow().isoformat() + "Z"
+# GET with If-None-Match: the last response is cached in redis with its ETag
+# (one hash per session, by url) and reused on 304 Not Modified
+def conditional_get(url, params=None):
+    redis = current_app.session_interface.redis
+    key = session_cache_key("etag", _session_key())
+    cached = redis.hget(key, url)
+    cached = json.loads(cached) if cached else None
+    headers = {"If-None-Match": cached["etag"]} if cached else {}
     authed_session = get_credentials()
-    url = "https://www.googleapis.com/calendar/v3/calendars/{}/events".format(
+    try:
+        get_budget().acquire("calendar")
+    except OverBudget:
+        # Out of budget: the last response is better than nothing
+        if cached:
+            return cached["body"]
+        raise
+    response = authed_session.get(url, params=params, headers=headers)
+    if response.status_code == 304:
+        return cached["body"]
+    body = response.json()
+    etag = response.headers.get("ETag")
+    if etag and response.status_code == 200:
+        pipe = redis.pipeline()
+        pipe.hset(key, url, json.dumps({"etag": etag, "body": body}))
+        pipe.expire(key, ETAG_TTL)
+        pipe.execute()
+    return body
+
+
+# Upcoming events served from the local copy, after an incremental sync
+# (skipped when the Calendar budget is over or the sync fails)
+def get_latest(n, cal=None):
+    store = event_store.EventStore(
+        current_app.session_interface.redis, _session_key(),
         cal if cal else session["default_calendar"])
-    response = authed_session.get(
-        url,
-        params={
-            "maxResults": n,
-            "timeMin": now,
-            "orderBy": "startTime",
-            "singleEvents": "true"
-        }).json()
-    return response["items"]
+    try:
+        store.sync(get_credentials(),
+                   lambda: get_budget().acquire("calendar"))
+    except (OverBudget, event_store.SyncError) as e:
+        print(e)
+    return store.upcoming(n)
+
+
+# Push notifications for the default calendar, sent to the webhook route
+# (renewed before the channel expires)
+def watch_calendar(address):
+    return calendar_watch.watch(current_app.session_interface.redis,
+                                get_credentials(), _session_key(),
+                                session_cache_key("watch", _session_key()),
+                                session["default_calendar"], address)
+
+
+# Stop the push notifications of the session (before logging out)
+def unwatch_calendar():
+    channel = calendar_watch.current_channel(
+        current_app.session_interface.redis,
+        session_cache_key("watch", _session_key()))
+    if channel:
+        calendar_watch.stop(current_app.session_interface.redis,
+                            get_credentials(), channel)
+
+
+# Calendar keys of the session, removed with it: local copies of the
+# calendars, push channel and its queue
+def session_calendar_keys():
+    redis = current_app.session_interface.redis
+    keys = event_store.session_keys(redis, _session_key()) + [
+        calendar_watch.QUEUE_PREFIX + _session_key()
+    ]
+    channel = calendar_watch.current_channel(
+        redis, session_cache_key("watch", _session_key()))
+    if channel:
+        keys.append(calendar_watch.CHANNEL_PREFIX + channel["id"])
+    return keys
 
 
 def get_credentials():
-    automatic_refresh()
-    token = session["oauth_token"]
+    token = get_token_broker().get_token(_session_key(),
+                                         session["oauth_token"], token_saver)
     credentials = google.oauth2.credentials.Credentials(
         token["access_token"],
         refresh_token=token["refresh_token"],
@@ -128,6 +203,22 @@ def get_credentials():
     return (authed_session)
 
 
+def get_budget():
+    return current_app.extensions["budget"]
+
+
+def get_token_broker():
+    return TokenBroker(current_app.session_interface.redis,
+                       current_app.config.get("CLIENT_ID"),
+                       current_app.config.get("CLIENT_SECRET"),
+                       current_app.config.get("REFRESH_URL"))
+
+
+# Redis key of the current session, shared with dododisplay
+def _session_key():
+    return current_app.session_interface.prefix + session.sid
+
+
 def get_user():
     if not ("username" in session):
         authed_session = get_credentials()
@@ -138,34 +229,8 @@ def get_user():
 
 
 def manual_refresh():
-    extra = {
-        "client_id": current_app.config.get("CLIENT_ID"),
-        "client_secret": current_app.config.get("CLIENT_SECRET"),
-    }
-    g = OAuth2Session(
-        current_app.config.get("CLIENT_ID"), token=session["oauth_token"])
-    # Trigger the update
-    g.get("https://www.googleapis.com/oauth2/v1/userinfo")
-    token_saver(
-        g.refresh_token(current_app.config.get("REFRESH_URL"), **extra))
-
-
-def automatic_refresh():
-    extra = {
-        "client_id": current_app.config.get("CLIENT_ID"),
-        "client_secret": current_app.config.get("CLIENT_SECRET"),
-    }
-    old = session["oauth_token"]["expires_at"]
-    g = OAuth2Session(
-        current_app.config.get("CLIENT_ID"),
-        token=session["oauth_token"],
-        auto_refresh_kwargs=extra,
-        auto_refresh_url=current_app.config.get("REFRESH_URL"),
-        token_updater=token_saver)
-    # Trigger the update
-    g.get("https://www.googleapis.com/oauth2/v1/userinfo")
-    if old < session["oauth_token"]["expires_at"]:
-        print("Token Updated")
+    get_token_broker().refresh(
+        _session_key(), session["oauth_token"], token_saver, force=True)
 
 
 def print_session_decoded(session_cookie):